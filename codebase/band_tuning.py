@@ -0,0 +1,212 @@
+"""
+Choice of the number of bands and of rows per band of the Jaccard LSH stage.
+
+Two documents of Jaccard similarity s share at least one of b bands of r rows
+with probability 1 - (1 - s^r)^b. For a target threshold t, the false positive
+area is the integral of that curve over [0, t] and the false negative area the
+integral of its complement over [t, 1]. The tuner minimises a weighted sum of 
+the two areas over all (b, r) with b * r at most the budget of hash functions, 
+and then takes the cheapest (b, r) within a tolerance of the best error.
+"""
+from   jaccard_distance import BAND_SIZE, BIT_SPACE, HASH_FUNC_COUNT, THRESHOLD
+from   jaccard_distance import UniversalHash
+from   jaccard_distance import band_hashes, build_signature_matrix
+from   jaccard_distance import exact_jaccard, get_files, get_shingle_arrays
+from   jaccard_distance import ingest_signatures, get_hash_funcs
+import numpy as np
+import os
+import random
+import sys
+
+# Weight of the false negative area, the false positive one weights 1 - it
+FN_WEIGHT = 0.5
+# Largest number of hash functions considered by tune_bands
+MAX_HASHES = 200
+# Error allowed above the best one to use fewer hash functions
+TOLERANCE = 0.002
+# Number of points of the numerical integration over [0, 1]
+STEPS = 2000
+# Number of random pairs of documents checked by validate_bands
+SAMPLE_SIZE = 10000
+
+
+def collision_probability(s, bands: int, rows: int):
+  """Probability that documents of Jaccard similarity s are candidates.
+  """
+  return 1 - pow(1 - np.power(s, rows), bands)
+
+
+def curve_threshold(bands: int, rows: int) -> float:
+  """Approximate similarity at which the S-curve is the steepest.
+  """
+  return pow(1 / bands, 1 / rows)
+
+
+def error_areas(threshold: float, 
+                bands: int, 
+                rows: int, 
+                steps: int=STEPS) -> tuple:
+  """False positive and false negative areas of the S-curve.
+
+  The integrals are computed with the midpoint rule over steps points.
+
+  Args:
+    threshold: target Jaccard similarity
+    bands: number of bands
+    rows: number of rows per band
+
+  Returns:
+    Tuple of the false positive area over [0, threshold] and the false negative
+    area over [threshold, 1]
+  """
+  s = (np.arange(0, steps) + 0.5) / steps
+  probability = collision_probability(s, bands, rows)
+  below = s < threshold
+
+  false_positive = probability[below].sum() / steps
+  false_negative = (1 - probability[~below]).sum() / steps
+  return (false_positive, false_negative)
+
+
+def tune_bands(threshold: float=THRESHOLD, 
+               fn_weight: float=FN_WEIGHT,
+               max_hashes: int=MAX_HASHES,
+               tolerance: float=TOLERANCE) -> tuple:
+  """Choose the number of bands and of rows per band for a threshold.
+
+  Args:
+    threshold: target Jaccard similarity
+    fn_weight: weight of the false negative area in [0, 1], the false positive 
+               area weights 1 - fn_weight
+    max_hashes: largest number of hash functions, bands * rows
+    tolerance: error allowed above the best one to use fewer hash functions
+
+  Returns:
+    Tuple of the number of bands, the number of rows per band and the weighted
+    error
+  """
+  if not 0 < threshold < 1:
+    raise ValueError("threshold must be in (0, 1)")
+
+  errors = {}
+  for rows in range(1, max_hashes + 1):
+    for bands in range(1, max_hashes // rows + 1):
+      fp, fn = error_areas(threshold, bands, rows)
+      errors[(bands, rows)] = (1 - fn_weight) * fp + fn_weight * fn
+
+  best = min(errors.values())
+  bands, rows = min((key for key, error in errors.items() 
+                     if error <= best + tolerance), 
+                    key=lambda key: (key[0] * key[1], errors[key]))
+
+  return (bands, rows, errors[(bands, rows)])
+
+
+def validate_bands(matrix, 
+                   shingles: list, 
+                   bands: int, 
+                   rows: int, 
+                   threshold: float=THRESHOLD,
+                   sample_size: int=SAMPLE_SIZE,
+                   seed: int=None) -> dict:
+  """Check a choice of bands against the exact Jaccard of sampled pairs.
+
+  Args:
+    matrix: signature matrix with at least bands * rows hash functions
+    shingles: sorted distinct shingle ids of every document, see 
+              get_shingle_arrays
+    bands: number of bands
+    rows: number of rows per band
+    threshold: target Jaccard similarity
+    sample_size: number of random pairs of distinct documents
+    seed: seed of the sampling
+
+  Returns:
+    Dictionary of the number of sampled pairs and of similar ones (exact 
+    Jaccard at least threshold), the observed and the expected recall, and the
+    observed and the expected fraction of the other pairs that are candidates
+  """
+  matrix = np.asarray(matrix)
+  keys = band_hashes(matrix[:, :bands * rows], rows)
+  rand = random.Random(seed)
+
+  similarity = np.empty(sample_size)
+  candidate = np.empty(sample_size, dtype=bool)
+  for k in range(0, sample_size):
+    i, j = rand.sample(range(0, len(shingles)), 2)
+    similarity[k] = exact_jaccard(shingles[i], shingles[j])
+    candidate[k] = (keys[i] == keys[j]).any()
+
+  similar = similarity >= threshold
+  expected = collision_probability(similarity, bands, rows)
+  def mean(values):
+    return float(values.mean()) if len(values) else float("nan")
+
+  return {"pairs": sample_size,
+          "similar": int(similar.sum()),
+          "recall": mean(candidate[similar]),
+          "expected_recall": mean(expected[similar]),
+          "false_positive_rate": mean(candidate[~similar]),
+          "expected_false_positive_rate": mean(expected[~similar])}
+
+
+def main(threshold: str=THRESHOLD, fn_weight: str=FN_WEIGHT):
+  threshold, fn_weight = float(threshold), float(fn_weight)
+  bands, rows, error = tune_bands(threshold, fn_weight)
+  print("bands", bands, "rows", rows, "hashes", bands * rows, "error", error,
+        "curve threshold", curve_threshold(bands, rows))
+  fp, fn = error_areas(threshold, HASH_FUNC_COUNT // BAND_SIZE, BAND_SIZE)
+  print("current", HASH_FUNC_COUNT // BAND_SIZE, "bands", BAND_SIZE, "rows",
+        "error", (1 - fn_weight) * fp + fn_weight * fn)
+
+  files = get_files()
+  if len(files) > 1:
+    shingles = get_shingle_arrays(files, use_cache=True)
+    matrix = ingest_signatures(files, get_hash_funcs(bands * rows, mixed=True),
+                               workers=os.cpu_count(), use_cache=True)
+    print(validate_bands(matrix, shingles, bands, rows, threshold))
+
+if __name__ == "__main__":
+  main(*sys.argv[1:])
+
+
+def test_tune_bands():
+  """Check if the tuned S-curve is close to the threshold and if the tolerance
+  trades error for fewer hash functions.
+  """
+  for threshold in (0.3, 0.5, 0.8):
+    bands, rows, error = tune_bands(threshold, max_hashes=60, tolerance=0)
+    assert abs(curve_threshold(bands, rows) - threshold) < 0.1
+    assert error < 0.06
+
+  exact = tune_bands(0.5, max_hashes=60, tolerance=0)
+  cheap = tune_bands(0.5, max_hashes=60, tolerance=0.01)
+  assert cheap[0] * cheap[1] <= exact[0] * exact[1]
+  assert exact[2] <= cheap[2] <= exact[2] + 0.01
+
+  # Weighting the false negatives more moves the curve to the left
+  recall = tune_bands(0.5, fn_weight=0.9, max_hashes=60, tolerance=0)
+  assert curve_threshold(*recall[:2]) < curve_threshold(*exact[:2])
+
+def test_validate_bands():
+  """Check the validation on documents with known similarities.
+  """
+  rand = random.Random(6)
+  ids = np.array(rand.sample(range(1, pow(2, 28)), 2000), dtype=np.uint32)
+  base = np.sort(ids[:1000])
+  shingles = [base, base, np.sort(ids[100:1000]), np.sort(ids[1000:])]
+  # Large multipliers, the ones drawn by UniversalHash are at most 31
+  hash_funcs = [UniversalHash(BIT_SPACE, 30, rand.getrandbits(30) | 1) 
+                for i in range(0, 40)]
+  matrix = build_signature_matrix(shingles, hash_funcs)
+  # The signatures are not degenerate, e.g. all 0, and estimate the similarity
+  # of the pairs of Jaccard 0.9
+  assert len(np.unique(matrix[0])) > 1 and (matrix[0] != matrix[3]).any()
+  assert abs((matrix[0] == matrix[2]).mean() - 0.9) < 0.2
+
+  result = validate_bands(matrix, shingles, 20, 2, 0.85, 500, seed=1)
+  assert result["pairs"] == 500
+  assert 0 < result["similar"] < 500
+  assert abs(result["recall"] - result["expected_recall"]) < 0.05
+  assert abs(result["false_positive_rate"] - 
+             result["expected_false_positive_rate"]) < 0.05
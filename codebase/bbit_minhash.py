@@ -0,0 +1,173 @@
+"""
+b-bit MinHash: signatures compressed to the lowest b bits of every value.
+
+Only the lowest b bits (b in 1, 2, 4, 8) of every value of the signature matrix
+are kept, packed in a uint8 array, so a signature of k values takes k*b/8 bytes.
+Two values are equal with probability J + (1 - J)/2^b for documents of Jaccard
+similarity J, as values of different shingles agree on their lowest b bits by
+chance (Li and König, 2010, for sparse sets). The estimator corrects that bias:
+J = (P - 2^-b) / (1 - 2^-b), where P is the fraction of equal packed values.
+"""
+import numpy as np
+
+# Number of set bits of every byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(0, 256)], dtype=np.uint8)
+# Number of rows compared at once by all_pairs_similarity
+BLOCK_SIZE = 256
+
+
+def pack_signatures(matrix, b: int) -> np.ndarray:
+  """Keep the lowest b bits of the signature values and pack them in bytes.
+
+  Args:
+    matrix: signature matrix of num_of_docs * k, e.g. of build_signature_matrix
+    b: number of bits kept, 1, 2, 4 or 8
+
+  Returns:
+    uint8 array of num_of_docs * ceil(k*b/8), the value j of a row is in bits
+    (j % (8/b)) * b to (j % (8/b) + 1) * b of byte j // (8/b)
+  """
+  if b not in (1, 2, 4, 8):
+    raise ValueError("b must be 1, 2, 4 or 8")
+
+  matrix = np.asarray(matrix)
+  if matrix.dtype.kind == "f":
+    # Signatures of create_signature_matrix for documents without shingles
+    matrix = np.where(np.isinf(matrix), 0, matrix)
+  low = (matrix.astype(np.uint64) & np.uint64(pow(2, b) - 1)).astype(np.uint8)
+
+  per_byte = 8 // b
+  padding = -low.shape[1] % per_byte
+  low = np.pad(low, ((0, 0), (0, padding)))
+  low = low.reshape(len(low), -1, per_byte)
+
+  packed = np.zeros(low.shape[:2], dtype=np.uint8)
+  for j in range(0, per_byte):
+    packed |= low[:, :, j] << np.uint8(j * b)
+
+  return packed
+
+
+def count_matches(x: np.ndarray, y: np.ndarray, b: int, k: int) -> np.ndarray:
+  """Number of equal b-bit values between packed signatures.
+
+  Args:
+    x: packed signatures, broadcastable with y
+    y: packed signatures
+    b: number of bits per value
+    k: number of values per signature
+
+  Returns:
+    Array of the number of equal values, over the last axis
+  """
+  diff = x ^ y
+  # Collect any set bit of a value on the lowest bit of the value
+  folded = diff.copy()
+  for shift in range(1, b):
+    folded |= diff >> np.uint8(shift)
+  lowest_bits = np.uint8(sum(1 << (j * b) for j in range(0, 8 // b)))
+
+  mismatches = POPCOUNT[folded & lowest_bits].sum(axis=-1, dtype=np.int64)
+  # The padding values are 0 in both signatures, so they never mismatch
+  return k - mismatches
+
+
+def estimate_similarity(matches: np.ndarray, b: int, k: int) -> np.ndarray:
+  """Bias corrected estimate of the Jaccard similarity.
+
+  Args:
+    matches: number of equal b-bit values, see count_matches
+    b: number of bits per value
+    k: number of values per signature
+
+  Returns:
+    Array of the estimated similarities, clipped to [0, 1]
+  """
+  chance = pow(2.0, -b)
+  similarity = (matches / k - chance) / (1 - chance)
+  return np.clip(similarity, 0, 1)
+
+
+def pair_similarity(packed: np.ndarray,
+                    pairs,
+                    b: int,
+                    k: int,
+                    block_size: int=BLOCK_SIZE * BLOCK_SIZE) -> np.ndarray:
+  """Estimated similarity of a list of pairs of documents.
+
+  Args:
+    packed: packed signatures, see pack_signatures
+    pairs: list or array of pairs (i, j) of indices of documents
+    b: number of bits per value
+    k: number of values per signature
+    block_size: number of pairs compared at once
+
+  Returns:
+    Array of the estimated similarity of every pair
+  """
+  pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+  matches = np.empty(len(pairs), dtype=np.int64)
+  for start in range(0, len(pairs), block_size):
+    block = pairs[start:start + block_size]
+    matches[start:start + len(block)] = count_matches(packed[block[:, 0]],
+                                                      packed[block[:, 1]],
+                                                      b, k)
+
+  return estimate_similarity(matches, b, k)
+
+
+def all_pairs_similarity(packed: np.ndarray,
+                         b: int,
+                         k: int,
+                         block_size: int=BLOCK_SIZE) -> np.ndarray:
+  """Estimated similarity of all the pairs of documents.
+
+  Args:
+    packed: packed signatures, see pack_signatures
+    b: number of bits per value
+    k: number of values per signature
+    block_size: number of rows compared at once with all the documents
+
+  Returns:
+    float32 array of num_of_docs * num_of_docs of the estimated similarities
+  """
+  similarity = np.empty((len(packed), len(packed)), dtype=np.float32)
+  for start in range(0, len(packed), block_size):
+    block = packed[start:start + block_size, None, :]
+    matches = count_matches(block, packed[None, :, :], b, k)
+    similarity[start:start + len(block)] = estimate_similarity(matches, b, k)
+
+  return similarity
+
+
+def test_pack_signatures():
+  """Check if the packed values are the lowest b bits of the signatures.
+  """
+  matrix = np.random.randint(0, pow(2, 28), size=(7, 21), dtype=np.uint32)
+  for b in (1, 2, 4, 8):
+    packed = pack_signatures(matrix, b)
+    per_byte = 8 // b
+    assert packed.shape == (7, -(-21 // per_byte))
+    for j in range(0, 21):
+      value = (packed[:, j // per_byte] >> ((j % per_byte) * b)) & (2**b - 1)
+      assert (value == matrix[:, j] % 2**b).all()
+
+def test_similarity():
+  """Check the number of matches and the estimated similarities.
+  """
+  k = 203
+  x = np.random.randint(0, pow(2, 28), size=k, dtype=np.uint32)
+  y = x.copy()
+  y[:100] += 1
+  matrix = np.stack([x, y, x])
+  for b in (1, 2, 4, 8):
+    packed = pack_signatures(matrix, b)
+    assert count_matches(packed[0], packed[1], b, k) == k - 100
+    assert pair_similarity(packed, [(0, 2), (2, 0)], b, k).tolist() == [1, 1]
+    expected = ((k - 100) / k - 2**-b) / (1 - 2**-b)
+    assert abs(pair_similarity(packed, [(0, 1)], b, k)[0] - expected) < 1e-9
+
+    similarity = all_pairs_similarity(packed, b, k, block_size=2)
+    assert np.allclose(similarity, similarity.T)
+    assert np.allclose(np.diag(similarity), 1)
+    assert np.isclose(similarity[0, 1], expected)
@@ -1,8 +1,14 @@
-from   docx        import Document
-from   Levenshtein import editops
-from   nltk.corpus import words
-from   pathlib     import Path
+from   concurrent.futures import ProcessPoolExecutor
+from   docx               import Document
+from   hash_family        import FINGERPRINT_SEED, extend_fingerprint
+from   hash_family        import fingerprint_transcript
+from   nltk.corpus        import words
+from   pathlib            import Path
+from   rapidfuzz.distance import Levenshtein
+from   rapidfuzz.process  import cdist
+from   verification       import edit_distance
 import math
+import numpy as np
 import os
 import random
 
@@ -12,6 +18,8 @@ MAX_DOC_SIZE = 25
 NUM_STRINGS = 100
 # Number of hash functions used
 NUM_HASH_FUNC = 1
+# Maximum number of distances computed at once by get_distance_histogram
+TILE_CELLS = pow(2, 22)
 # 64 most significat characters in the documents
 ACCEPTABLE_CHARS = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 
                     'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 
@@ -82,22 +90,7 @@ class HashFamily:
     Returns:
       A tuple containing the updated string s and the index i
     """
-    # Convert xi into int
-    try:
-      val = ACCEPTABLE_CHARS.index(x[i]) + 1
-    except ValueError:
-      # Handle value error when the char is not present in ACCEPTABLE_CHARS.
-      val = 0
-    
-    # Product of multiplier, xi and |s|.
-    prod = self.multiplier * val * len(s)
-    # print(self.multiplier, val, len(s), prod)
-    prod = prod % pow(2, 32)
-
-    # Get the values of r1 and r2
-    r2 = ((prod % 1024) >> (5)) / 32
-    r1 = (prod % 32) / 32
-    # print(r1,r2)
+    r1, r2 = self.get_rho(x[i], len(s))
 
     # Determine the value of hashed string based on r1, r2, pa, pr
     if r1 <= self.pa:
@@ -114,6 +107,68 @@ class HashFamily:
 
     return (s, i)
 
+  def get_rho(self, xi: str, size: int) -> tuple:
+    """Compute rho(xi, |s|) as described in the class.
+
+    Args:
+      xi:   the character which we are processing
+      size: the size of the output string at this point
+
+    Returns:
+      A tuple of the two numbers (r1, r2)
+    """
+    # Convert xi into int
+    try:
+      val = ACCEPTABLE_CHARS.index(xi) + 1
+    except ValueError:
+      # Handle value error when the char is not present in ACCEPTABLE_CHARS.
+      val = 0
+    
+    # Product of multiplier, xi and |s|.
+    prod = self.multiplier * val * size
+    prod = prod % pow(2, 32)
+
+    # Get the values of r1 and r2
+    r2 = ((prod % 1024) >> (5)) / 32
+    r1 = (prod % 32) / 32
+
+    return (r1, r2)
+
+  def fingerprint_str(self, x: str) -> int:
+    """Compute the 64 bit fingerprint of the hashed string of x while it is 
+    generated, without building the hashed string itself.
+
+    Args:
+      x: input string
+
+    Returns:
+      The fingerprint of the hashed string, or None if it is incomplete.
+    """
+    fp = FINGERPRINT_SEED
+    size = 0
+    i = 0
+    while (i < len(x) and 
+           size < ((8 * MAX_DOC_SIZE)/(1 - self.pa)) 
+                    + 6 * math.log(NUM_STRINGS)):
+      r1, r2 = self.get_rho(x[i], size)
+      if r1 <= self.pa:
+        # hash-insert
+        fp = extend_fingerprint(fp, ord(u"\u22A5"))
+      elif r2 <= self.pr:
+        # hash-replace
+        fp = extend_fingerprint(fp, ord(u"\u22A5"))
+        i+=1
+      else:
+        # hash-match
+        fp = extend_fingerprint(fp, ord(x[i]))
+        i+=1
+      size += 1
+
+    if i < len(x):
+      return None
+
+    return fp
+
 
 def get_p_values() -> tuple:
   """Randomize thevalue of p to get the values of pa and pr
@@ -142,13 +197,14 @@ def get_words() -> list:
   return word_list[(-1)*NUM_STRINGS:]
 
 
-def hash_strs(text: list) -> dict:
+def hash_strs(text: list, fingerprint: bool=False) -> dict:
   """Consider each paragraph of the file as a string, hash the string and store
   the value in a dict with key as the hashed string and value as a list of index
   of the file.
 
   Args:
     text: list of text in all files
+    fingerprint: key the dict by the 64 bit fingerprint of the hashed string
 
   Returns:
     Dict of list of file index containing the key as hashed_str
@@ -161,9 +217,12 @@ def hash_strs(text: list) -> dict:
   hash_values = {}
   
   for (i,content) in enumerate(text):
-    hashed_str = rho.hash_str(content)
+    if fingerprint:
+      hashed_str = rho.fingerprint_str(content)
+    else:
+      hashed_str = rho.hash_str(content)
 
-    if hashed_str != "INCOMPLETE":
+    if hashed_str is not None and hashed_str != "INCOMPLETE":
       if hashed_str in hash_values:
         hash_values[hashed_str].add(i)
       else:
@@ -172,7 +231,7 @@ def hash_strs(text: list) -> dict:
   return hash_values
 
 
-def get_candidate_pairs(text: list) -> set:
+def get_candidate_pairs(text: list, fingerprint: bool=False) -> set:
   """Traverse through all the files for NUM_HASH_FUNC times and get the pairs
   of documents which might have same paragraphs.
   We hash each paragraph and compare this hashed string for each file, if any
@@ -182,13 +241,14 @@ def get_candidate_pairs(text: list) -> set:
 
   Args:
     paragraphs: list of all the paragraphs in the files
+    fingerprint: key the buckets by the fingerprints of the hashed strings
 
   Returns:
     set of candidate pairs
   """
   candidate_pairs = set()
   for i in range(0, NUM_HASH_FUNC):
-    hash_values = hash_strs(text)
+    hash_values = hash_strs(text, fingerprint)
     # Generate candidate pairs for each key
     for value in hash_values.values():
       for k in value:
@@ -200,47 +260,125 @@ def get_candidate_pairs(text: list) -> set:
 
 
 def get_edit_distance(candidate_pairs: set, word_list: list) -> list:
-  """Get the edit distance operations to convert first string into the second
-  string in each tuple.
+  """Get the edit distance between the first string and the second string in 
+  each tuple.
 
   Args:
     candidate_pairs: pairs of similar words
     word_list: universal list of words
 
   Returns:
-    List of edit operations for each tuple in candidate_pairs
+    List of edit distances for each tuple in candidate_pairs
   """
-  edit_operations = []
+  edit_distances = []
   for (i, j) in candidate_pairs:
-    edit_operations.append(editops(word_list[i], word_list[j]))
+    edit_distances.append(edit_distance(word_list[i], word_list[j]))
+
+  return edit_distances
+
+
+def get_distance_histogram(word_list: list, 
+                           max_bin: int=None, 
+                           workers: int=1,
+                           tile_cells: int=TILE_CELLS) -> dict:
+  """Count the pairs of different words of word_list at each edit distance.
+
+  The pairs are split in tiles of consecutive rows of the upper triangle of the
+  distance matrix. Each tile is computed at once with rapidfuzz.process.cdist 
+  (the library behind Levenshtein) and reduced to a histogram, and the tiles 
+  are shared among a process pool.
+
+  Args:
+    word_list: list of words
+    max_bin: if given, distances larger than max_bin are counted in max_bin and
+             their computation stops at max_bin
+    workers: number of processes
+    tile_cells: maximum number of distances computed in a tile
+
+  Returns:
+    Dictionary with key as the edit distance, from 0 to the largest one, and 
+    value as the number of pairs of different words at that distance.
+  """
+  n = len(word_list)
+  rows = max(1, tile_cells // max(n, 1))
+  tiles = [(i, min(i + rows, n)) for i in range(0, n, rows)]
+
+  if workers <= 1:
+    init_histogram_worker(word_list, max_bin)
+    tile_counts = [get_tile_histogram(tile) for tile in tiles]
+  else:
+    with ProcessPoolExecutor(max_workers=workers, 
+                             initializer=init_histogram_worker, 
+                             initargs=(word_list, max_bin)) as pool:
+      tile_counts = list(pool.map(get_tile_histogram, tiles))
 
-  return edit_operations
+  counts = np.zeros(max([len(tile) for tile in tile_counts], default=0), 
+                    dtype=np.int64)
+  for tile in tile_counts:
+    counts[:len(tile)] += tile
 
+  if max_bin is not None:
+    counts = np.pad(counts, (0, max(0, max_bin + 1 - len(counts))))
+
+  return {d: int(count) for d, count in enumerate(counts)}
+
+
+def init_histogram_worker(word_list: list, max_bin: int):
+  """Store the words and the ids of the distinct words in the worker process.
+  """
+  global HISTOGRAM_ARGS
+  ids = np.unique(np.array(word_list, dtype=object), return_inverse=True)[1]
+  HISTOGRAM_ARGS = (word_list, ids, max_bin)
+
+
+def get_tile_histogram(tile: tuple) -> np.ndarray:
+  """Histogram of the distances between the words of the rows of a tile and the
+  words after them.
+
+  Args:
+    tile: first and last (excluded) row of the tile
+
+  Returns:
+    Array containing the number of pairs at each distance
+  """
+  word_list, ids, max_bin = HISTOGRAM_ARGS
+  start, end = tile
+  matrix = cdist(word_list[start:end], 
+                 word_list[start:], 
+                 scorer=Levenshtein.distance,
+                 score_cutoff=max_bin,
+                 dtype=np.int32)
+  if max_bin is not None:
+    matrix = np.minimum(matrix, max_bin)
 
-def verify_the_bounds(edit_operations: list, word_list: list):
+  # Keep the pairs (i, j) with i < j of different words
+  i = np.arange(start, end)[:, None]
+  j = np.arange(start, len(word_list))[None, :]
+  keep = (j > i) & (ids[start:end, None] != ids[None, start:])
+
+  return np.bincount(matrix[keep])
+
+
+def verify_the_bounds(edit_distances: list, word_list: list):
   """Verify if ED(x,y)<=r then P(hashed_value(x)=hashed_value(y))>=p^r-2/n^2
   and if ED(x,y)>=cr then P(hashed_value(x)=hashed_value(y))<=(2p)^cr
 
   Args:
-    edit_operations: list of edit operations for all the words with same hashed
-                     strings
+    edit_distances: list of edit distances for all the words with same hashed
+                    strings
     word_list: all the words in the dictionary we are using
   """
+  histogram = get_distance_histogram(word_list, workers=os.cpu_count())
+  # The bins read below go up to 24, larger distances get their own bins.
+  size = max(25, len(histogram), max(edit_distances, default=0) + 1)
   ED_calculated = {}
   ED_actual = {}
-  for i in range(0, 25):
+  for i in range(0, size):
     ED_calculated[i] = 0
-    ED_actual[i] = 0
+    ED_actual[i] = histogram.get(i, 0)
 
-  for i in edit_operations:
-    l = len(i)
+  for l in edit_distances:
     ED_calculated[l] += 1
-  
-  for i in word_list:
-    for j in word_list:
-      if i < j:
-        l = len(editops(i, j))
-        ED_actual[l] += 1
 
   c = 5    
   for r in range(1, 5):
@@ -260,7 +398,7 @@ def verify_the_bounds(edit_operations: list, word_list: list):
     # For ED > cr
     sum_actual = 0
     sum_calculated = 0
-    for i in range(c*r,25):
+    for i in range(c*r,size):
       sum_actual += ED_actual[i]
       sum_calculated += ED_calculated[i]
     
@@ -276,8 +414,8 @@ def verify_the_bounds(edit_operations: list, word_list: list):
 def main():
   words = get_words()
   candidate_pairs = get_candidate_pairs(words)
-  edit_operations = get_edit_distance(candidate_pairs, words)
-  verify_the_bounds(edit_operations, words)
+  edit_distances = get_edit_distance(candidate_pairs, words)
+  verify_the_bounds(edit_distances, words)
 
 if __name__ == "__main__":
   main()
@@ -366,4 +504,43 @@ def test_repetitions_candidate_pairs():
     visited_pairs.add((j,i))
     
   assert True
- 
\ No newline at end of file
+ 
+def test_fingerprint_str():
+  """Check if the fingerprint matches the fingerprint of the hashed string.
+  """
+  rho = HashFamily()
+  for i in range(0, 20):
+    l = random.randint(1, 15)
+    x = ""
+    for j in range(0, l):
+      x+= random.choice(ACCEPTABLE_CHARS)
+
+    hashed_str = rho.hash_str(x)
+    if hashed_str == "INCOMPLETE":
+      assert rho.fingerprint_str(x) is None
+    else:
+      assert rho.fingerprint_str(x) == fingerprint_transcript(hashed_str)
+
+def test_distance_histogram():
+  """Check the histogram against the distances of all the pairs of words.
+  """
+  word_list = []
+  for i in range(0, 60):
+    l = random.randint(0, 8)
+    word_list.append("".join(random.choice(ACCEPTABLE_CHARS[:3]) 
+                             for j in range(l)))
+
+  expected = {}
+  for i in word_list:
+    for j in word_list:
+      if i < j:
+        l = edit_distance(i, j)
+        expected[l] = expected.get(l, 0) + 1
+
+  histogram = get_distance_histogram(word_list, tile_cells=100, workers=2)
+  assert {d: c for d, c in histogram.items() if c > 0} == expected
+  assert len(histogram) == max(expected) + 1
+
+  capped = get_distance_histogram(word_list, max_bin=3, tile_cells=100)
+  assert len(capped) == 4
+  assert capped[3] == sum(c for d, c in expected.items() if d >= 3)
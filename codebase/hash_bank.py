@@ -0,0 +1,200 @@
+"""
+Bank of pre-generated hash functions saved on disk.
+
+A bank is a set of seeded hash functions generated once for the parameters 
+(p, alphabet, str_len, num_strings, count) and a master seed. As a seeded hash 
+function is rebuilt from its seed alone, the bank is stored as a small JSON file
+containing the parameters and the seeds. Its ID is derived from its content, so 
+indexes, experiments and tests can load the same bank by ID across runs.
+"""
+from   hash_family import HashFamily, get_p_values, get_seeds
+from   pathlib     import Path
+import hashlib
+import json
+import os
+import random
+import sys
+
+BANK_FOLDER = Path("./banks/")
+
+
+class HashBank:
+  """Bank of seeded hash functions sharing the same parameters.
+  """
+
+  def __init__(self, 
+               p: float, 
+               alphabet: list, 
+               str_len: int, 
+               num_strings: int, 
+               seeds: list):
+    """Initialise the class
+    Args:
+        p:           the value of p referred in the paper
+        alphabet:    list of all the alphabet in the database
+        str_len:     length of the longest string in database
+        num_strings: number of strings in database
+        seeds:       seeds of the hash functions
+    """
+    self.p = p
+    self.alphabet = alphabet
+    self.str_len = str_len
+    self.num_strings = num_strings
+    self.seeds = seeds
+
+    pa, pr = get_p_values(p)
+    self.families = [HashFamily(pa, 
+                                pr, 
+                                str_len=str_len, 
+                                num_strings=num_strings,
+                                alphabet=alphabet,
+                                seed=s) 
+                     for s in seeds]
+
+  def to_dict(self) -> dict:
+    """Parameters and seeds of the bank.
+    """
+    return {"p": self.p,
+            "alphabet": self.alphabet,
+            "str_len": self.str_len,
+            "num_strings": self.num_strings,
+            "seeds": self.seeds}
+
+  def get_id(self) -> str:
+    """ID of the bank, the hash of its content.
+    """
+    content = json.dumps(self.to_dict(), sort_keys=True).encode("utf-8")
+    return hashlib.sha1(content).hexdigest()[:16]
+
+
+def generate_bank(p: float, 
+                  alphabet: list, 
+                  str_len: int, 
+                  num_strings: int, 
+                  count: int,
+                  seed: int=None,
+                  folder: Path=BANK_FOLDER) -> str:
+  """Generate a bank of hash functions and save it.
+
+  Args:
+    p:           the value of p referred in the paper
+    alphabet:    list of all the alphabet in the database
+    str_len:     length of the longest string in database
+    num_strings: number of strings in database
+    count:       number of hash functions
+    seed:        master seed, a random one is drawn if not given
+    folder:      folder in which the bank is saved
+
+  Returns:
+    ID of the bank
+  """
+  if seed is None:
+    seed = random.getrandbits(64)
+
+  bank = HashBank(p, list(alphabet), str_len, num_strings, 
+                  get_seeds(seed, count))
+  return save_bank(bank, folder)
+
+
+def save_bank(bank: HashBank, folder: Path=BANK_FOLDER) -> str:
+  """Save a bank in the folder.
+
+  Args:
+    bank:   object of the HashBank class
+    folder: folder in which the bank is saved
+
+  Returns:
+    ID of the bank
+  """
+  bank_id = bank.get_id()
+  os.makedirs(folder, exist_ok=True)
+  with open(os.path.join(folder, bank_id + ".json"), "w") as f:
+    json.dump(bank.to_dict(), f)
+
+  return bank_id
+
+
+def load_bank(bank_id: str, folder: Path=BANK_FOLDER) -> HashBank:
+  """Load a bank saved by generate_bank.
+
+  Args:
+    bank_id: ID of the bank
+    folder:  folder in which the bank is saved
+
+  Returns:
+    Object of the HashBank class
+  """
+  with open(os.path.join(folder, bank_id + ".json"), "r") as f:
+    return HashBank(**json.load(f))
+
+
+def get_bank(p: float, 
+             alphabet: list, 
+             str_len: int, 
+             num_strings: int, 
+             count: int,
+             seed: int=0,
+             folder: Path=BANK_FOLDER) -> str:
+  """Get the ID of the bank for the given parameters and master seed, 
+  generating it only if it was not saved before.
+
+  Returns:
+    ID of the bank
+  """
+  bank = HashBank(p, list(alphabet), str_len, num_strings, 
+                  get_seeds(seed, count))
+  bank_id = bank.get_id()
+  if not os.path.isfile(os.path.join(folder, bank_id + ".json")):
+    save_bank(bank, folder)
+
+  return bank_id
+
+
+def get_bank_families(p: float, 
+                      alphabet: list, 
+                      str_len: int, 
+                      num_strings: int, 
+                      count: int,
+                      seed: int=0,
+                      folder: Path=BANK_FOLDER) -> list:
+  """Hash functions of the bank of get_bank, loaded by its ID, so that tests 
+  and experiments run on the same hash functions.
+
+  Returns:
+    List of objects of the HashFamily class
+  """
+  bank_id = get_bank(p, alphabet, str_len, num_strings, count, seed, folder)
+  return load_bank(bank_id, folder).families
+
+
+def main(p: str, alphabet: str, str_len: str, num_strings: str, count: str):
+  """Generate a bank from the command line and print its ID, e.g.
+  python hash_bank.py 0.1 ATCG$ 100 1682 1000
+  """
+  print(generate_bank(float(p), list(alphabet), int(str_len), int(num_strings),
+                      int(count)))
+
+
+if __name__ == "__main__":
+  main(*sys.argv[1:])
+
+
+def test_load_bank(tmp_path):
+  """Check if a loaded bank contains the same hash functions as the generated 
+  one.
+  """
+  alphabet = ['A', 'T', 'C', 'G', '$']
+  bank_id = generate_bank(0.1, alphabet, 20, 50, 10, seed=3, folder=tmp_path)
+  assert get_bank(0.1, alphabet, 20, 50, 10, seed=3, folder=tmp_path) == bank_id
+  families = get_bank_families(0.1, alphabet, 20, 50, 10, seed=3, 
+                               folder=tmp_path)
+  assert [rho.seed for rho in families] == get_seeds(3, 10)
+
+  bank = load_bank(bank_id, tmp_path)
+  assert bank.get_id() == bank_id
+  assert len(bank.families) == 10
+
+  x = "".join(random.choice(alphabet) for i in range(0, 15))
+  expected = HashBank(0.1, alphabet, 20, 50, get_seeds(3, 10))
+  assert ([rho.hash_str(x) for rho in bank.families] == 
+          [rho.hash_str(x) for rho in expected.families])
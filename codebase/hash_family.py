@@ -3,6 +3,7 @@ Contains the Hash Family class where we define the hash family(rho) based on
 McCauley.
 """
 import math
+import numpy as np
 import random
 
 # Assuming that all the documents have a size less than 100
@@ -20,6 +21,17 @@ R_VALUE = 2
 C_VALUE = 10
 # Number of hash functions used = O(1/p1), where p1=p^r-2/n^2
 NUM_HASH_FUNC = math.ceil(1/P_VALUE**R_VALUE - (2/NUM_STRINGS**2))
+# Symbol appended to the transcript on hash-insert and hash-replace.
+BOTTOM = u"\u22A5"    # ⊥
+# Number of strings advanced together by HashFamily.hash_many.
+BATCH_SIZE = 4096
+# Constants of the splitmix64 generator used by the seeded rho.
+MASK64 = (1 << 64) - 1
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+MIX_1 = 0xBF58476D1CE4E5B9
+MIX_2 = 0x94D049BB133111EB
+# Fingerprint of the empty transcript.
+FINGERPRINT_SEED = 0x6A09E667F3BCC908
 
 
 class HashFamily:
@@ -33,7 +45,8 @@ class HashFamily:
                pr: float=-1, 
                str_len: int=MAX_STRING_SIZE, 
                num_strings: int=NUM_STRINGS,
-               alphabet: list=ACCEPTABLE_CHARS):
+               alphabet: list=ACCEPTABLE_CHARS,
+               seed: int=None):
     """Initialise the class
     Args:
         pa:          value of pa referred in the paper
@@ -41,6 +54,8 @@ class HashFamily:
         str_len:     length of the longest string in database
         num_strings: number of strings in database
         alphabet:    list of all the alphabet in the database
+        seed:        if given, rho is computed on demand from this seed instead
+                     of being stored as a dictionary
     """
     if pa == -1 or pr == -1:
       self.pa, self.pr = get_p_values()
@@ -49,8 +64,12 @@ class HashFamily:
       self.pr = pr
 
     self.alphabet = alphabet
+    self.str_len = str_len
+    self.num_strings = num_strings
+    self.seed = seed
     self.max_len = ((8 * str_len)/(1 - self.pa)) + 6 * math.log(num_strings)
     self.rho = self.generate_rho()
+    self.rho_table = None
   
   def hash_str(self, x: str) -> str:
     """We perform the hash function until i < |x| and |s| < 8d/(1-pa)+6log(n)
@@ -107,6 +126,211 @@ class HashFamily:
       i += 1
 
     return (s, i)
+
+  def fingerprint_str(self, x: str) -> int:
+    """Compute the fingerprint of h{rho}(x) without building the transcript.
+
+    Every symbol of the transcript is folded into a 64 bit rolling fingerprint
+    as soon as it is generated, see extend_fingerprint.
+
+    Args:
+      x: input string
+
+    Returns:
+      The fingerprint of h{rho}(x), or None if the transcript is incomplete.
+    """
+    fp = FINGERPRINT_SEED
+    size = 0
+    i = 0
+    while i < len(x) and size < self.max_len:
+      r1,r2 = self.rho[(x[i],size)]
+      if r1 <= self.pa:
+        # hash-insert
+        fp = extend_fingerprint(fp, ord(BOTTOM))
+      elif r2 <= self.pr:
+        # hash-replace
+        fp = extend_fingerprint(fp, ord(BOTTOM))
+        i += 1
+      else:
+        # hash-match
+        fp = extend_fingerprint(fp, ord(x[i]))
+        i += 1
+      size += 1
+
+    if i < len(x):
+      return None
+
+    return fp
+
+  def hash_many(self, 
+                strings: list, 
+                batch_size: int=BATCH_SIZE, 
+                fingerprint: bool=False) -> list:
+    """Hash a list of strings, returning the same values as hash_str.
+
+    Instead of walking one string at a time, the transcripts of a batch of 
+    strings are advanced in lockstep: at every step each unfinished string reads
+    (r1, r2) from the array form of rho and appends one symbol to its 
+    transcript. The transcripts are kept as arrays of code points and only 
+    turned into strings once every string of the batch is finished.
+
+    Args:
+      strings:     list of input strings
+      batch_size:  number of strings advanced together
+      fingerprint: return the values of fingerprint_str instead of hash_str
+
+    Returns:
+      List of h{rho}(x) for every x in strings, in the same order.
+    """
+    if fingerprint:
+      fps, complete = self.fingerprint_many(strings, batch_size)
+      return [int(fp) if c else None for fp, c in zip(fps, complete)]
+
+    hashed = []
+    for start in range(0, len(strings), batch_size):
+      transcript, complete = self.run_batch(strings[start:start + batch_size],
+                                            fingerprint=False)
+      width = transcript.shape[1]
+      batch = transcript.view(f"<U{width}").ravel().tolist()
+      # if the string is not completely traversed then the transcript is 
+      # incomplete
+      for k in np.flatnonzero(~complete):
+        batch[k] = "NOT-COMPLETE"
+      hashed.extend(batch)
+
+    return hashed
+
+  def fingerprint_many(self, 
+                       strings: list, 
+                       batch_size: int=BATCH_SIZE) -> tuple:
+    """Compute the fingerprints of a list of strings in lockstep.
+
+    Args:
+      strings:    list of input strings
+      batch_size: number of strings advanced together
+
+    Returns:
+      Tuple of an array of the fingerprints of h{rho}(x) and an array telling 
+      if the transcript of x is complete, for every x in strings.
+    """
+    fps = np.empty(len(strings), dtype=np.uint64)
+    complete = np.empty(len(strings), dtype=bool)
+    for start in range(0, len(strings), batch_size):
+      end = min(start + batch_size, len(strings))
+      fps[start:end], complete[start:end] = self.run_batch(strings[start:end],
+                                                           fingerprint=True)
+
+    return (fps, complete)
+
+  def run_batch(self, strings: list, fingerprint: bool) -> tuple:
+    """Advance the transcripts of all the strings in lockstep.
+
+    Args:
+      strings:     list of input strings
+      fingerprint: keep only the rolling fingerprints of the transcripts
+
+    Returns:
+      Tuple of the result and an array telling if each transcript is complete.
+      The result is an array of the fingerprints if fingerprint is True, else a
+      2D array of num_strings * ceil(max_len) containing the code points of the
+      transcripts, padded with 0.
+    """
+    codes, lengths = self.encode(strings)
+    width = math.ceil(self.max_len)
+    symbols = np.array([ord(c) for c in self.alphabet], dtype=np.uint32)
+
+    if fingerprint:
+      fps = np.full(len(strings), FINGERPRINT_SEED, dtype=np.uint64)
+    else:
+      transcript = np.zeros((len(strings), width), dtype=np.uint32)
+    i = np.zeros(len(strings), dtype=np.int64)
+    size = np.zeros(len(strings), dtype=np.int64)
+
+    # Indices of the strings whose transcript is still being computed.
+    active = np.flatnonzero(lengths > 0)
+    while active.size > 0:
+      xi = codes[active, i[active]]
+      pos = size[active]
+      r1, r2 = self.get_rho_values(xi, pos)
+
+      # hash-match and hash-replace consume xi, hash-insert does not.
+      advance = r1 > self.pa
+      match = advance & (r2 > self.pr)
+      points = np.where(match, symbols[xi], ord(BOTTOM))
+      if fingerprint:
+        fps[active] = extend_fingerprint_array(fps[active], points)
+      else:
+        transcript[active, pos] = points
+      i[active] += advance
+      size[active] += 1
+
+      active = active[(i[active] < lengths[active]) & 
+                      (size[active] < self.max_len)]
+
+    return (fps if fingerprint else transcript, i == lengths)
+
+  def encode(self, strings: list) -> tuple:
+    """Convert the strings into a matrix of indices in the alphabet.
+
+    Args:
+      strings: list of input strings
+
+    Returns:
+      A tuple of a 2D array of num_strings * longest_string containing the index
+      of every character in the alphabet and an array of the string lengths.
+    """
+    lengths = np.array([len(x) for x in strings], dtype=np.int64)
+    codes = np.zeros((len(strings), lengths.max(initial=0)), dtype=np.int64)
+
+    # Map the code point of every character to its index in the alphabet.
+    lookup = np.full(max(ord(c) for c in self.alphabet) + 1, -1, dtype=np.int64)
+    for index, c in enumerate(self.alphabet):
+      lookup[ord(c)] = index
+
+    points = np.frombuffer("".join(strings).encode("utf-32-le"), 
+                           dtype=np.uint32)
+    known = points < len(lookup)
+    values = np.full(len(points), -1, dtype=np.int64)
+    values[known] = lookup[points[known]]
+    if (values < 0).any():
+      raise KeyError(chr(points[np.argmax(values < 0)]))
+
+    rows = np.repeat(np.arange(len(strings)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    cols = np.arange(len(points)) - np.repeat(starts, lengths)
+    codes[rows, cols] = values
+
+    return (codes, lengths)
+
+  def get_rho_values(self, xi: np.ndarray, pos: np.ndarray) -> tuple:
+    """Evaluate rho for arrays of characters and transcript sizes.
+
+    Args:
+      xi:  indices of the characters in the alphabet
+      pos: current sizes of the transcripts
+
+    Returns:
+      Tuple of the arrays r1 and r2.
+    """
+    if isinstance(self.rho, SeededRho):
+      return self.rho.get_values(xi, pos)
+
+    table = self.get_rho_table()
+    return (table[xi, pos, 0], table[xi, pos, 1])
+
+  def get_rho_table(self) -> np.ndarray:
+    """Array form of rho, built once from the dictionary.
+
+    Returns:
+      3D array of |alphabet| * ceil(max_len) * 2 where table[a, k] holds the 
+      values (r1, r2) of rho(alphabet[a], k).
+    """
+    if self.rho_table is None:
+      width = math.ceil(self.max_len)
+      self.rho_table = np.array([[self.rho[(x, i)] for i in range(0, width)]
+                                 for x in self.alphabet], dtype=np.float64)
+
+    return self.rho_table
   
   def generate_rho(self) -> dict:
     """Generate a rho function which rakes the value of the alphabet and current
@@ -115,8 +339,12 @@ class HashFamily:
     
     Returns:
       Dictionary with key as a tuple of (xi,|s|) and value as a tuple of two 
-      random numbers (r1,r2) from 0 to 1.
+      random numbers (r1,r2) from 0 to 1. If the class has a seed, a SeededRho 
+      which computes the same kind of mapping on demand.
     """
+    if self.seed is not None:
+      return SeededRho(self.seed, self.alphabet, math.ceil(self.max_len))
+
     rho = {}
     for x in self.alphabet:
       for i in range(0,math.ceil(self.max_len)):
@@ -125,6 +353,341 @@ class HashFamily:
     return rho
 
 
+class SeededRho:
+  """rho computed on demand from a 64 bit seed.
+
+  The pair (r1, r2) for the key (xi, |s|) is obtained by mixing the seed with 
+  the code point of xi, |s| and the index of the number with the splitmix64 
+  finalizer, and keeping the top 53 bits of the result as a float in [0,1).
+  Nothing is stored apart from the seed, so any hash function can be rebuilt 
+  from its seed alone.
+  """
+
+  def __init__(self, seed: int, alphabet: list, width: int):
+    """Initialise the class
+    Args:
+        seed:     the seed of the hash function
+        alphabet: list of all the alphabet in the database
+        width:    number of values of |s| for which rho is defined
+    """
+    self.seed = seed
+    self.key = mix64(seed & MASK64)
+    self.alphabet = set(alphabet)
+    self.width = width
+    self.points = np.array([ord(c) for c in alphabet], dtype=np.uint64)
+
+  def __getitem__(self, key: tuple) -> tuple:
+    """Get the values of (r1, r2) for the key (xi, |s|)
+    """
+    x, i = key
+    if x not in self.alphabet or i < 0 or i >= self.width:
+      raise KeyError(key)
+
+    counter = (ord(x) << 32) | (int(i) << 1)
+    return (to_unit(mix64(self.key + counter * GOLDEN_GAMMA)),
+            to_unit(mix64(self.key + (counter | 1) * GOLDEN_GAMMA)))
+
+  def get_values(self, xi: np.ndarray, pos: np.ndarray) -> tuple:
+    """Vectorized form of __getitem__.
+
+    Args:
+      xi:  indices of the characters in the alphabet
+      pos: current sizes of the transcripts
+
+    Returns:
+      Tuple of the arrays r1 and r2.
+    """
+    return seeded_rho_values(np.uint64(self.key), self.points[xi], pos)
+
+
+def seeded_rho_values(keys: np.ndarray, 
+                      points: np.ndarray, 
+                      pos: np.ndarray) -> tuple:
+  """Values (r1, r2) of seeded rho functions, see SeededRho.
+
+  Args:
+    keys:   mixed seeds of the rho functions
+    points: code points of the characters
+    pos:    current sizes of the transcripts
+
+  Returns:
+    Tuple of the arrays r1 and r2.
+  """
+  counter = ((points.astype(np.uint64) << np.uint64(32)) | 
+             (pos.astype(np.uint64) << np.uint64(1)))
+  gamma = np.uint64(GOLDEN_GAMMA)
+  return (to_unit_array(mix64_array(keys + counter * gamma)),
+          to_unit_array(mix64_array(keys + (counter | np.uint64(1)) * gamma)))
+
+
+def mix64(z: int) -> int:
+  """splitmix64 finalizer of a 64 bit integer.
+  """
+  z &= MASK64
+  z = ((z ^ (z >> 30)) * MIX_1) & MASK64
+  z = ((z ^ (z >> 27)) * MIX_2) & MASK64
+  return z ^ (z >> 31)
+
+
+def mix64_array(z: np.ndarray) -> np.ndarray:
+  """splitmix64 finalizer of an array of 64 bit integers, same as mix64.
+  """
+  z = z.astype(np.uint64)
+  z = (z ^ (z >> np.uint64(30))) * np.uint64(MIX_1)
+  z = (z ^ (z >> np.uint64(27))) * np.uint64(MIX_2)
+  return z ^ (z >> np.uint64(31))
+
+
+def to_unit(z: int) -> float:
+  """Map a 64 bit integer to a float in [0,1) using its top 53 bits.
+  """
+  return (z >> 11) * 2.0**-53
+
+
+def to_unit_array(z: np.ndarray) -> np.ndarray:
+  """Vectorized form of to_unit.
+  """
+  return (z >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def extend_fingerprint(fp: int, point: int) -> int:
+  """Append a symbol, given by its code point, to a transcript fingerprint.
+  """
+  return mix64(fp + point * GOLDEN_GAMMA)
+
+
+def extend_fingerprint_array(fp: np.ndarray, points: np.ndarray) -> np.ndarray:
+  """Vectorized form of extend_fingerprint.
+  """
+  return mix64_array(fp + points.astype(np.uint64) * np.uint64(GOLDEN_GAMMA))
+
+
+def fingerprint_transcript(s: str) -> int:
+  """Fingerprint of a transcript, same as the one computed by fingerprint_str.
+  """
+  fp = FINGERPRINT_SEED
+  for c in s:
+    fp = extend_fingerprint(fp, ord(c))
+
+  return fp
+
+
+def fingerprint_collisions(families: list, 
+                           strings: list, 
+                           bits: int=64) -> dict:
+  """Count the fingerprint collisions of a list of hash functions on a corpus.
+
+  Two different transcripts of the same hash function sharing a fingerprint 
+  would merge two buckets. For m distinct transcripts, the expected number of 
+  colliding pairs of a fingerprint of b bits is m(m-1)/2^(b+1).
+
+  Args:
+    families: list of objects of the HashFamily class
+    strings:  the corpus
+    bits:     number of low bits of the fingerprints compared, to measure the
+              collisions of shorter keys
+
+  Returns:
+    Dictionary with the number of distinct complete transcripts, the number of 
+    observed collisions and the expected number of collisions summed over all 
+    the hash functions.
+  """
+  mask = (1 << bits) - 1
+  report = {"transcripts": 0, "collisions": 0, "expected": 0.0}
+  for rho in families:
+    transcripts = set(rho.hash_many(strings))
+    transcripts.discard("NOT-COMPLETE")
+    fps = {fingerprint_transcript(s) & mask for s in transcripts}
+    m = len(transcripts)
+    report["transcripts"] += m
+    report["collisions"] += m - len(fps)
+    report["expected"] += m * (m - 1) / 2**(bits + 1)
+
+  return report
+
+
+def fingerprint_bank(families: list, 
+                     strings: list, 
+                     batch_size: int=BATCH_SIZE * 64) -> tuple:
+  """Compute the fingerprints of the strings under a bank of hash functions.
+
+  Every (hash function, string) couple is a lane and all the lanes are advanced
+  in lockstep, so the bank is evaluated with as many array operations as there 
+  are steps in the longest transcript, instead of once per hash function. The 
+  hash functions must be seeded and share pa, pr, max_len and the alphabet.
+
+  Args:
+    families:   list of seeded objects of the HashFamily class
+    strings:    list of input strings
+    batch_size: maximum number of lanes advanced together
+
+  Returns:
+    Tuple of two 2D arrays of num_families * num_strings, the fingerprints 
+    of h{rho}(x) and if the transcript of x is complete.
+  """
+  fps = np.empty((len(families), len(strings)), dtype=np.uint64)
+  complete = np.empty((len(families), len(strings)), dtype=bool)
+  if not families or not strings:
+    return (fps, complete)
+
+  rho = check_bank(families)
+
+  codes, lengths = rho.encode(strings)
+  points = np.array([ord(c) for c in rho.alphabet], dtype=np.uint64)
+  keys = np.array([mix64(other.seed & MASK64) for other in families], 
+                  dtype=np.uint64)
+
+  step = max(1, batch_size // len(strings))
+  for start in range(0, len(families), step):
+    end = min(start + step, len(families))
+    # Lane l is the string l % num_strings under hash function l // num_strings
+    row = np.tile(np.arange(len(strings)), end - start)
+    key = np.repeat(keys[start:end], len(strings))
+    fp = np.full(len(row), FINGERPRINT_SEED, dtype=np.uint64)
+    i = np.zeros(len(row), dtype=np.int64)
+    size = np.zeros(len(row), dtype=np.int64)
+
+    active = np.flatnonzero(lengths[row] > 0)
+    while active.size > 0:
+      xi = codes[row[active], i[active]]
+      r1, r2 = seeded_rho_values(key[active], points[xi], size[active])
+
+      # hash-match and hash-replace consume xi, hash-insert does not.
+      advance = r1 > rho.pa
+      match = advance & (r2 > rho.pr)
+      fp[active] = extend_fingerprint_array(
+                     fp[active], np.where(match, points[xi], ord(BOTTOM)))
+      i[active] += advance
+      size[active] += 1
+
+      active = active[(i[active] < lengths[row[active]]) & 
+                      (size[active] < rho.max_len)]
+
+    fps[start:end] = fp.reshape(end - start, len(strings))
+    complete[start:end] = (i == lengths[row]).reshape(end - start, len(strings))
+
+  return (fps, complete)
+
+
+def fingerprint_trie(families: list, 
+                     strings: list, 
+                     batch_size: int=BATCH_SIZE * 64) -> tuple:
+  """Same as fingerprint_bank, sharing the work on the common prefixes.
+
+  For a fixed rho, the state (i, |s|, s) of the transcript just after reading
+  the prefix x[:i] depends only on that prefix, i.e. on a node of the trie of 
+  the strings. The nodes of every depth are found by sorting, and all the 
+  (hash function, node) lanes of a depth are advanced in lockstep from the 
+  state of their parent until they read their character. The steps are thus
+  run once per edge of the trie, and duplicate strings are hashed once.
+
+  Args:
+    families:   list of seeded objects of the HashFamily class
+    strings:    list of input strings
+    batch_size: maximum number of lanes advanced together
+
+  Returns:
+    Tuple of two 2D arrays of num_families * num_strings, the fingerprints 
+    of h{rho}(x) and if the transcript of x is complete.
+  """
+  fps = np.full((len(families), len(strings)), FINGERPRINT_SEED, 
+                dtype=np.uint64)
+  complete = np.ones((len(families), len(strings)), dtype=bool)
+  if not families or not strings:
+    return (fps, complete)
+
+  rho = check_bank(families)
+  codes, lengths = rho.encode(strings)
+  points = np.array([ord(c) for c in rho.alphabet], dtype=np.uint64)
+  keys = np.array([mix64(other.seed & MASK64) for other in families], 
+                  dtype=np.uint64)
+
+  # parents[d] and chars[d] give the parent and the character of every node at
+  # depth d + 1, and nodes[d] the node of depth d + 1 of the strings ending 
+  # there.
+  parents, chars, nodes = [], [], []
+  node = np.zeros(len(strings), dtype=np.int64)
+  for d in range(0, int(lengths.max(initial=0))):
+    alive = np.flatnonzero(lengths > d)
+    edge = node[alive] * len(points) + codes[alive, d]
+    unique, node[alive] = np.unique(edge, return_inverse=True)
+    parents.append(unique // len(points))
+    chars.append(unique % len(points))
+    nodes.append(node[lengths == d + 1])
+
+  step = max(1, batch_size // max([len(p) for p in parents] + [1]))
+  for start in range(0, len(families), step):
+    key = keys[start:start + step]
+    fp = np.full((len(key), 1), FINGERPRINT_SEED, dtype=np.uint64)
+    size = np.zeros((len(key), 1), dtype=np.int64)
+    alive = np.ones((len(key), 1), dtype=bool)
+
+    for d in range(0, len(parents)):
+      # Every lane starts from the state of its parent and reads one character
+      fp = np.take(fp, parents[d], axis=1)
+      size = np.take(size, parents[d], axis=1)
+      alive = np.take(alive, parents[d], axis=1) & (size < rho.max_len)
+      lane_key = np.repeat(key, len(parents[d]))
+      lane_point = np.tile(points[chars[d]], len(key))
+      flat_fp, flat_size, flat_alive = fp.ravel(), size.ravel(), alive.ravel()
+
+      active = np.flatnonzero(flat_alive)
+      while active.size > 0:
+        point = lane_point[active]
+        r1, r2 = seeded_rho_values(lane_key[active], point, flat_size[active])
+
+        # hash-match and hash-replace consume the character, hash-insert does
+        # not.
+        advance = r1 > rho.pa
+        match = advance & (r2 > rho.pr)
+        flat_fp[active] = extend_fingerprint_array(
+                            flat_fp[active], 
+                            np.where(match, point, ord(BOTTOM)))
+        flat_size[active] += 1
+
+        waiting = active[~advance]
+        flat_alive[waiting] = flat_size[waiting] < rho.max_len
+        active = waiting[flat_alive[waiting]]
+
+      ending = lengths == d + 1
+      fps[start:start + step, ending] = fp[:, nodes[d]]
+      complete[start:start + step, ending] = alive[:, nodes[d]]
+
+  return (fps, complete)
+
+
+def check_bank(families: list) -> HashFamily:
+  """Check if a bank of hash functions can be evaluated in lockstep.
+
+  Args:
+    families: list of objects of the HashFamily class
+
+  Returns:
+    The first hash function of the bank
+  """
+  rho = families[0]
+  for other in families:
+    if (other.seed is None or other.pa != rho.pa or other.pr != rho.pr or
+        other.max_len != rho.max_len or other.alphabet != rho.alphabet):
+      raise ValueError("The bank must contain seeded hash functions which "
+                       "share pa, pr, max_len and the alphabet")
+
+  return rho
+
+
+def get_seeds(seed: int, hash_func: int) -> list:
+  """Derive the seeds of hash_func hash functions from a master seed.
+
+  Args:
+    seed:      the master seed
+    hash_func: number of hash functions
+
+  Returns:
+    List of the seeds of the hash functions
+  """
+  return [mix64(seed + (i + 1) * GOLDEN_GAMMA) for i in range(0, hash_func)]
+
+
 def get_p_values(p: float=P_VALUE) -> tuple:
   """Randomize thevalue of p to get the values of pa and pr
 
@@ -6,11 +6,18 @@ Automatically generated by Colaboratory.
 Original file is located at
     https://colab.research.google.com/drive/1lVT-5m-gL_7auwaOUBenQF-lkXN7sLc7
 """
-from   docx    import Document
-from   pathlib import Path
+from   concurrent.futures import ProcessPoolExecutor
+from   docx               import Document
+from   hash_family        import GOLDEN_GAMMA, mix64, mix64_array
+from   pathlib            import Path
+from   shingle_cache      import get_cache_key, load_entry, store_entry
+import collections
+import itertools
 import math
+import numpy as np
 import os
 import random
+import sys
 
 DATA_FOLDER = Path("./dataset/")
 HASH_FUNC_COUNT = 20
@@ -18,6 +25,16 @@ BAND_SIZE = 5
 BIT_SPACE = 32
 SHINGLE_SIZE = 5   # 5-shingles
 NUM_SIGNATURES_LOG = 16  #final_bits
+# Jaccard similarity of the pairs kept by verify_candidates
+THRESHOLD = 0.8
+# Number of shingles hashed at once by build_signature_matrix
+CHUNK_SIZE = pow(2, 16)
+# Number of files in flight per worker process of iter_signatures
+WINDOW_FACTOR = 2
+# Signature of the documents without shingles in build_signature_matrix
+EMPTY_SIGNATURE = np.iinfo(np.uint32).max
+# Starting value of the keys of the bands
+BAND_SEED = 0xBB67AE8584CAA73B
 # 64 most significat characters in the documents
 ACCEPTABLE_CHARS = ['\\', '!', '"', '#', '$', '&', "'", '(', ')', '*', '+', ',', 
                     '-', '.', '/', '0', '1', '2', '3', '4', '5', '6', '7', '8', 
@@ -25,32 +42,150 @@ ACCEPTABLE_CHARS = ['\\', '!', '"', '#', '$', '&', "'", '(', ')', '*', '+', ',',
                     'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 
                     'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 
                     'z', '~', '·', '–']
+# Index of every acceptable character, the other characters get 0 as in 
+# preprocess_shingles.
+CHAR_CODES = {c: i for i, c in enumerate(ACCEPTABLE_CHARS)}
+CODE_TABLE = np.zeros(max(ord(c) for c in ACCEPTABLE_CHARS) + 1, dtype=np.int64)
+for c, i in CHAR_CODES.items():
+  CODE_TABLE[ord(c)] = i
 
 
 class UniversalHash:
   """Class define inf functions from the 2/m hash family
   """
 
-  def __init__(self, bit_space, range_space):
+  def __init__(self, bit_space, range_space, multiplier=None):
+    self.bit_space = bit_space
+    self.range_space = range_space
     self.h_range = pow(2, range_space)
     self.width = bit_space - range_space
-    self.multiplier = random.randint(1, bit_space/2 - 1)
-    self.multiplier = (2*self.multiplier + 1) % self.h_range
+    if multiplier is None:
+      multiplier = random.randint(1, bit_space/2 - 1)
+      multiplier = (2*multiplier + 1) % self.h_range
+    self.multiplier = multiplier
 
   def get_value(self, num):
     return int((num * self.multiplier) % self.h_range) >> self.width
 
 
-def get_files() -> list:
+class MixedHash:
+  """Hash function of well mixed 32 bit values.
+
+  The shingle id is offset by a key drawn from the seed and mixed by the 
+  splitmix64 finalizer, as in OnePermutationHash, and the high 32 bits are 
+  kept. The multipliers of UniversalHash are small odd numbers, so its values 
+  mostly follow the order of the ids and the shingle id 0 hashes to 0: the 
+  minimum of most documents is the hash of the same small id, and unrelated 
+  documents get equal signatures. MixedHash has no such order.
+  """
+
+  def __init__(self, seed: int=None):
+    """Initialise the class
+    Args:
+        seed: seed of the hash function, a random one if not given
+    """
+    if seed is None:
+      seed = random.getrandbits(64)
+    self.seed = seed
+    self.key = mix64(seed)
+
+  def get_value(self, num):
+    return mix64(num + self.key) >> 32
+
+
+class OnePermutationHash:
+  """One permutation hashing with densification.
+
+  Every shingle is hashed once into 32 bits, the range of the hash is split in
+  count bins of equal size and the signature value of a bin is the minimum hash
+  falling in it. An empty bin borrows the value of the non-empty bin chosen by
+  a hash of (bin, attempt), retrying until a non-empty bin is hit (optimal 
+  densification of Shrivastava, 2017). The choice only depends on the bin, so 
+  two documents with the same non-empty bins borrow from the same bins.
+  The signature of a document costs O(|shingles| + count) instead of 
+  O(|shingles| * count), and has the same shape as the one of 
+  build_signature_matrix.
+  """
+
+  def __init__(self, count: int=HASH_FUNC_COUNT, seed: int=None):
+    """Initialise the class
+    Args:
+        count: number of bins, i.e. of values in a signature
+        seed: seed of the hash functions, a random one if not given
+    """
+    if seed is None:
+      seed = random.getrandbits(64)
+    self.count = count
+    self.seed = seed
+    self.key = mix64(seed)
+    self.densify_key = mix64(seed + GOLDEN_GAMMA)
+
+  def __len__(self) -> int:
+    return self.count
+
+  def get_signatures(self, data: list) -> np.ndarray:
+    """Signature matrix of the documents.
+
+    Args:
+      data: List of set (or array) of indices of all the shingles present in 
+            the respective document
+
+    Returns:
+      Signature matrix, a uint32 array of num_of_docs * count. The documents 
+      without shingles have the value EMPTY_SIGNATURE.
+    """
+    signature = np.full((len(data), self.count), EMPTY_SIGNATURE, 
+                        dtype=np.uint32)
+    for index, d in enumerate(data):
+      if not isinstance(d, np.ndarray):
+        d = np.fromiter(d, dtype=np.uint64, count=len(d))
+      if len(d) > 0:
+        signature[index] = self.get_signature(d.astype(np.uint64))
+
+    return signature
+
+  def get_signature(self, ids: np.ndarray) -> np.ndarray:
+    """Signature of a non-empty document.
+    """
+    values = mix64_array(ids + np.uint64(self.key)) >> np.uint64(32)
+    bins = (values * np.uint64(self.count)) >> np.uint64(32)
+
+    # The first value of each bin in increasing order of values is its minimum
+    order = np.argsort(values)
+    filled, first = np.unique(bins[order], return_index=True)
+    signature = np.full(self.count, EMPTY_SIGNATURE, dtype=np.uint32)
+    signature[filled] = values[order][first]
+
+    is_filled = np.zeros(self.count, dtype=bool)
+    is_filled[filled] = True
+    empty = np.flatnonzero(~is_filled).astype(np.uint64)
+    attempt = 1
+    while len(empty) > 0:
+      counter = (empty << np.uint64(32)) | np.uint64(attempt)
+      source = (mix64_array(np.uint64(self.densify_key) + 
+                            counter * np.uint64(GOLDEN_GAMMA)) % 
+                np.uint64(self.count))
+      hit = is_filled[source]
+      signature[empty[hit]] = signature[source[hit]]
+      empty = empty[~hit]
+      attempt += 1
+
+    return signature
+
+
+def get_files(folder: Path=DATA_FOLDER) -> list:
   """Get all the files from the dataset folder
 
+  Args:
+    folder: folder of the files
+
   Returns:
     list: os paths of all the dataset files
   """
   files = []
-  for entry in os.listdir(DATA_FOLDER):
-    if os.path.isfile(os.path.join(DATA_FOLDER, entry)):
-        files.append(os.path.join(DATA_FOLDER, entry))
+  for entry in os.listdir(folder):
+    if os.path.isfile(os.path.join(folder, entry)):
+        files.append(os.path.join(folder, entry))
   
   return files
 
@@ -76,48 +211,110 @@ def preprocess_shingles(shingle: str) -> int:
   return val
 
 
-def hash_LSH(data, hash_func):
-  """We hash the values for each band and return the buckets
-  """
-  ret = set()
-  for i in data:
-    ret.add(hash_func.get_value(i))
-
-  return ret
-
-def get_shingles(files):
+def get_shingles(files, use_cache: bool=False):
   """
   This will return shingles table in the form of list of sets
   Where each index in the list would correspond to the document and the set
   would denote if the minhash of each shingle is present in the document.
   Example: shingles = [{1, 3, 6}, {2, 4, 16, 25, 36}, ...]
+
+  If use_cache is True, the parsed text and the shingles of every file are 
+  read from the cache of shingle_cache when the file did not change.
   """
   # List of shingles in respective files
   shingles = []
 
   for f in files:
-    # extract content from files
-    content = [p.text.lower() for p in Document(f).paragraphs]
-    content = "\n".join(content)
-
-    current_shingle = ""
-    all_shingles = set()
-
     # Add all the shingles in set
-    for char in content:
-      current_shingle += char
-      if len(current_shingle) > SHINGLE_SIZE:
-        # If the shingle is longer we trim it
-        current_shingle = current_shingle[1:]
-        all_shingles.add(preprocess_shingles(current_shingle))
-      elif len(current_shingle) == SHINGLE_SIZE :
-        all_shingles.add(preprocess_shingles(current_shingle))
-
-    shingles.append(all_shingles)
+    text, ids = get_document(f, use_cache)
+    shingles.append(set(ids.tolist()))
+
   return shingles
 
 
-def create_signature_matrix(data : list) -> list:
+def get_document(f: str, use_cache: bool=False) -> tuple:
+  """Get the content of a file and its sorted distinct shingle ids.
+
+  Args:
+    f: path of the file
+    use_cache: read and store the result in the cache of shingle_cache
+
+  Returns:
+    Tuple of the lowercase text and the uint32 array of shingle ids
+  """
+  if use_cache:
+    key = get_cache_key(f, SHINGLE_SIZE, ACCEPTABLE_CHARS)
+    entry = load_entry(key)
+    if entry is not None:
+      return entry
+
+  text = read_document(f)
+  ids = np.unique(shingle_ids(text)).astype(np.uint32)
+  if use_cache:
+    store_entry(key, text, ids)
+
+  return (text, ids)
+
+
+def get_shingle_arrays(files, use_cache: bool=False) -> list:
+  """Same as get_shingles, with the shingles of every document held in a 
+  sorted uint32 array instead of a set.
+  """
+  return [get_document(f, use_cache)[1] for f in files]
+
+
+def read_document(f: str) -> str:
+  """Extract the lowercase content of a file, one paragraph per line.
+  """
+  content = [p.text.lower() for p in Document(f).paragraphs]
+  return "\n".join(content)
+
+
+def iter_shingles(content: str):
+  """Generate the shingles of a text, as given by preprocess_shingles, in 
+  streaming.
+
+  The value of the shingle is a number in base len(ACCEPTABLE_CHARS), so the 
+  next shingle is obtained in O(1) by dropping the leading digit and appending
+  the code of the new character.
+
+  Args:
+    content: the text
+
+  Yields:
+    Integer equivalent of every SHINGLE_SIZE window of the text, in order
+  """
+  base = len(ACCEPTABLE_CHARS)
+  modulus = pow(base, SHINGLE_SIZE - 1)
+  val = 0
+  for count, char in enumerate(content, 1):
+    val = (val % modulus) * base + CHAR_CODES.get(char, 0)
+    if count >= SHINGLE_SIZE:
+      yield val
+
+
+def shingle_ids(content: str) -> np.ndarray:
+  """Vectorized form of iter_shingles for a whole document.
+
+  Args:
+    content: the text
+
+  Returns:
+    Array of the integer equivalent of every SHINGLE_SIZE window of the text
+  """
+  points = np.frombuffer(content.encode("utf-32-le"), dtype=np.uint32)
+  known = points < len(CODE_TABLE)
+  codes = np.where(known, CODE_TABLE[np.where(known, points, 0)], 0)
+
+  count = len(codes) - SHINGLE_SIZE + 1
+  ids = np.zeros(max(count, 0), dtype=np.int64)
+  for j in range(0, SHINGLE_SIZE):
+    ids = ids * len(ACCEPTABLE_CHARS) + codes[j:j + len(ids)]
+
+  return ids
+
+
+def create_signature_matrix(data : list, hash_funcs: list=None) -> list:
   """Create the minHash Signatures using hash functions
   Algorithm followed in the function:
   1. Initialise the signature matrix to infinity
@@ -137,14 +334,51 @@ def create_signature_matrix(data : list) -> list:
   Args:
     data: List of set of indices of all the shingles present in the respective 
           document
+    hash_funcs: hash functions used, HASH_FUNC_COUNT new ones if not given
   
   Returns:
     Signature matrix, a 2D matrix of num_of_docs * num_of_hash_functions 
     containing the minHash signatures of the documents w.r.t each of the hash
     function
   """
+  # Initialise the hash functions which simulates the generation of minHash 
+  # signatures
+  if hash_funcs is None:
+    hash_funcs = get_hash_funcs()
+
   # Initialise signatures to infinity
-  signature = [[float('inf') for j in range(0, HASH_FUNC_COUNT)] for i in data]
+  signature = [[float('inf') for j in range(0, len(hash_funcs))] for i in data]
+
+  # Hash all the values in sparse matrix and store the minimum value
+  for index, d in enumerate(data):
+    for i in d:
+      for j in range(0, len(hash_funcs)):
+        # For every hash function, we modify the signature value
+        signature[index][j] = min(signature[index][j],
+                                  hash_funcs[j].get_value(i))
+
+  return signature
+
+
+def get_hash_funcs(count: int=HASH_FUNC_COUNT, 
+                   one_permutation: bool=False,
+                   mixed: bool=False) -> list:
+  """Initialise the hash functions which simulates the generation of minHash 
+  signatures.
+
+  Args:
+    count: number of hash functions
+    one_permutation: use one permutation hashing with count bins instead
+    mixed: use objects of the MixedHash class instead of UniversalHash
+
+  Returns:
+    List of objects of the UniversalHash (or MixedHash) class, or an object of
+    the OnePermutationHash class
+  """
+  if one_permutation:
+    return OnePermutationHash(count)
+  if mixed:
+    return [MixedHash() for i in range(0, count)]
 
   # Bits needed to store values in signature matrix
   signature_bits = math.ceil(
@@ -152,57 +386,575 @@ def create_signature_matrix(data : list) -> list:
                       pow(len(ACCEPTABLE_CHARS), SHINGLE_SIZE), 
                       2))
 
-  # Initialise the hash functions which simulates the generation of minHash 
-  # signatures
-  hash_funcs = [UniversalHash(BIT_SPACE, signature_bits)
-                for i in range(0, HASH_FUNC_COUNT)]
+  return [UniversalHash(BIT_SPACE, signature_bits) for i in range(0, count)]
 
-  # Hash all the values in sparse matrix and store the minimum value
+
+def get_hash_params(hash_funcs) -> dict:
+  """Parameters of hash functions which can be saved as JSON, see 
+  load_hash_funcs.
+
+  Args:
+    hash_funcs: list of objects of the UniversalHash or MixedHash class, or an
+                object of the OnePermutationHash class
+  """
+  if isinstance(hash_funcs, OnePermutationHash):
+    return {"one_permutation": [hash_funcs.count, hash_funcs.seed]}
+  if is_mixed(hash_funcs):
+    return {"mixed_hash": [h.seed for h in hash_funcs]}
+
+  return {"hash_funcs": [[h.bit_space, h.range_space, h.multiplier] 
+                         for h in hash_funcs]}
+
+
+def load_hash_funcs(params: dict):
+  """Hash functions given by their parameters, see get_hash_params.
+  """
+  if "one_permutation" in params:
+    return OnePermutationHash(*params["one_permutation"])
+  if "mixed_hash" in params:
+    return [MixedHash(seed) for seed in params["mixed_hash"]]
+
+  return [UniversalHash(*h) for h in params["hash_funcs"]]
+
+
+def is_mixed(hash_funcs) -> bool:
+  """Whether hash_funcs is a non-empty list of objects of the MixedHash class.
+  """
+  return (isinstance(hash_funcs, list) and len(hash_funcs) > 0 and 
+          isinstance(hash_funcs[0], MixedHash))
+
+
+def hash_values(ids: np.ndarray, hash_funcs: list) -> np.ndarray:
+  """Values of all the hash functions on an array of shingle ids.
+
+  Args:
+    ids: uint64 array of shingle ids
+    hash_funcs: list of objects of the UniversalHash or MixedHash class
+
+  Returns:
+    uint64 array of len(ids) * len(hash_funcs)
+  """
+  ids = ids[:, None]
+  if is_mixed(hash_funcs):
+    keys = np.array([h.key for h in hash_funcs], dtype=np.uint64)
+    return mix64_array(ids + keys) >> np.uint64(32)
+
+  multipliers = np.array([h.multiplier for h in hash_funcs], dtype=np.uint64)
+  masks = np.array([h.h_range - 1 for h in hash_funcs], dtype=np.uint64)
+  widths = np.array([h.width for h in hash_funcs], dtype=np.uint64)
+  return ((ids * multipliers) & masks) >> widths
+
+
+def build_signature_matrix(data: list, 
+                           hash_funcs: list=None, 
+                           chunk_size: int=CHUNK_SIZE) -> np.ndarray:
+  """Vectorized form of create_signature_matrix.
+
+  The shingles of a document are held in a uint64 array and all the hash 
+  functions are applied at once with hash_values. The minimum is taken over 
+  chunks of chunk_size shingles, so at most chunk_size * num_of_hash_functions
+  values are held in memory.
+
+  Args:
+    data: List of set (or array) of indices of all the shingles present in the
+          respective document
+    hash_funcs: hash functions used, HASH_FUNC_COUNT new ones if not given. 
+                May be a list of objects of the MixedHash class or an object of
+                the OnePermutationHash class.
+    chunk_size: number of shingles hashed at once
+
+  Returns:
+    Signature matrix, a uint32 array of num_of_docs * num_of_hash_functions. 
+    The documents without shingles have the value EMPTY_SIGNATURE.
+  """
+  if hash_funcs is None:
+    hash_funcs = get_hash_funcs()
+  if isinstance(hash_funcs, OnePermutationHash):
+    return hash_funcs.get_signatures(data)
+
+  signature = np.full((len(data), len(hash_funcs)), EMPTY_SIGNATURE, 
+                      dtype=np.uint32)
   for index, d in enumerate(data):
-    for i in d:
-      for j in range(0, HASH_FUNC_COUNT):
-        # For every hash function, we modify the signature value
-        signature[index][j] = min(signature[index][j],
-                                  hash_funcs[j].get_value(i))
+    if not isinstance(d, np.ndarray):
+      d = np.fromiter(d, dtype=np.uint64, count=len(d))
+    d = d.astype(np.uint64, copy=False)
+
+    for start in range(0, len(d), chunk_size):
+      values = hash_values(d[start:start + chunk_size], hash_funcs)
+      signature[index] = np.minimum(signature[index], values.min(axis=0))
 
   return signature
 
-def get_candidate_pair(matrix : list) -> set:
+
+def ingest_signatures(files: list, 
+                      hash_funcs: list=None, 
+                      workers: int=1,
+                      use_cache: bool=False) -> np.ndarray:
+  """Parse, shingle and sign the files in a process pool.
+
+  The paths of the files are streamed to the workers, and each worker sends 
+  back only the signature row of its document, so the memory of the parent 
+  does not depend on the size of the documents.
+
+  Args:
+    files: paths of the files
+    hash_funcs: hash functions used, HASH_FUNC_COUNT new ones if not given
+    workers: number of processes
+    use_cache: use the cache of shingle_cache for the parsed documents
+
+  Returns:
+    Signature matrix, same as build_signature_matrix(get_shingles(files))
+  """
+  if hash_funcs is None:
+    hash_funcs = get_hash_funcs()
+
+  signature = np.empty((len(files), len(hash_funcs)), dtype=np.uint32)
+  rows = iter_signatures(files, hash_funcs, workers, use_cache)
+  for index, row in enumerate(rows):
+    signature[index] = row
+
+  return signature
+
+
+def iter_signatures(files, 
+                    hash_funcs: list, 
+                    workers: int=1,
+                    use_cache: bool=False):
+  """Yield the signature row of every file, in the order of files.
+
+  The files are read from the iterable as the rows are consumed, so files may
+  be an unbounded stream.
+
+  Args:
+    files: paths of the files, may be a generator
+    hash_funcs: hash functions used
+    workers: number of processes
+    use_cache: use the cache of shingle_cache for the parsed documents
+  """
+  if workers <= 1:
+    init_ingest_worker(hash_funcs, use_cache)
+    for f in files:
+      yield get_signature_row(f)
+    return
+
+  # At most WINDOW_FACTOR * workers files are submitted ahead of the row 
+  # yielded, so a stream of files is never drained in advance.
+  with ProcessPoolExecutor(max_workers=workers,
+                           initializer=init_ingest_worker,
+                           initargs=(hash_funcs, use_cache)) as pool:
+    pending = collections.deque()
+    for f in files:
+      pending.append(pool.submit(get_signature_row, f))
+      if len(pending) >= WINDOW_FACTOR * workers:
+        yield pending.popleft().result()
+
+    while pending:
+      yield pending.popleft().result()
+
+
+def init_ingest_worker(hash_funcs: list, use_cache: bool):
+  """Store the arguments shared by all the files in the worker process.
+  """
+  global INGEST_ARGS
+  INGEST_ARGS = (hash_funcs, use_cache)
+
+
+def get_signature_row(f: str) -> np.ndarray:
+  """Signature row of a file, computed in a worker process.
+  """
+  hash_funcs, use_cache = INGEST_ARGS
+  text, ids = get_document(f, use_cache)
+  return build_signature_matrix([ids], hash_funcs)[0]
+
+
+class BandIndex:
+  """Hash tables of the bands of a growing set of documents.
+
+  The tables are keyed by the keys of band_hashes, so a document is added or 
+  looked up in O(num_of_bands).
+  """
+
+  def __init__(self, num_bands: int):
+    self.tables = [{} for i in range(0, num_bands)]
+
+  def add(self, doc: int, keys: np.ndarray):
+    """Add the document with id doc and band keys keys.
+    """
+    for table, key in zip(self.tables, keys.tolist()):
+      if key in table:
+        table[key].append(doc)
+      else:
+        table[key] = [doc]
+
+  def query(self, keys: np.ndarray) -> set:
+    """Ids of the documents sharing at least one band key with keys.
+    """
+    candidates = set()
+    for table, key in zip(self.tables, keys.tolist()):
+      candidates.update(table.get(key, ()))
+
+    return candidates
+
+
+def get_candidate_pair(matrix, band_size: int=BAND_SIZE) -> set:
   """Hash bands in signature matrix and create candidate pairs on collision.
 
+  Every band has its own hash table, keyed by the 64 bit hash of the full band
+  (see band_hashes), and the documents in the same bucket of a table form the 
+  candidate pairs. The cost is that of sorting the keys of every band plus the
+  number of candidate pairs.
+
   Args:
     matrix: signature matrix
+    band_size: number of rows in a band
 
   Returns:
     List of candidate pairs
   """
   candidate_pairs = set()
 
-  for i in range(0, int(HASH_FUNC_COUNT/BAND_SIZE)):
-    hash_values = []
+  keys = band_hashes(matrix, band_size)
+  for band in range(0, keys.shape[1]):
+    for bucket in get_band_buckets(keys[:, band]):
+      candidate_pairs.update(itertools.combinations(bucket.tolist(), 2))
+
+  return candidate_pairs
 
-    # Change the hash function for every band
-    hash_func = UniversalHash(BIT_SPACE, NUM_SIGNATURES_LOG)
 
-    # Get the buckets for every band
-    for index, d in enumerate(matrix):
-      hash_values.append(hash_LSH(d[i*BAND_SIZE:(i+1)*BAND_SIZE], hash_func))
+def band_hashes(matrix, band_size: int=BAND_SIZE) -> np.ndarray:
+  """Hash every band of every document into a 64 bit key.
 
-    # Compare the buckets with each other to get pairs
-    for ind_i, i in enumerate(hash_values):
-      for ind_j, j in enumerate(hash_values):
-        # Check for equal pairs
-        if i == j and ind_i < ind_j:
-          candidate_pairs.add((ind_i, ind_j))
+  The key is built by mixing the signature values of the band one after the 
+  other, so it depends on their order and multiplicity.
+
+  Args:
+    matrix: signature matrix, as a list of lists or an array
+    band_size: number of rows in a band
+
+  Returns:
+    Array of num_of_docs * num_of_bands containing the key of every band
+  """
+  matrix = np.asarray(matrix)
+  if matrix.dtype.kind == "f":
+    # Signatures of create_signature_matrix for documents without shingles
+    matrix = np.where(np.isinf(matrix), EMPTY_SIGNATURE, matrix)
+  matrix = matrix.astype(np.uint64).reshape(len(matrix), -1)
+
+  num_bands = matrix.shape[1] // band_size
+  keys = np.full((len(matrix), num_bands), BAND_SEED, dtype=np.uint64)
+  for band in range(0, num_bands):
+    for j in range(band * band_size, (band + 1) * band_size):
+      keys[:, band] = mix64_array(keys[:, band] + 
+                                  (matrix[:, j] + np.uint64(1)) * 
+                                  np.uint64(GOLDEN_GAMMA))
+
+  return keys
+
+
+def similarity_join(reference_files: list, 
+                    probe_files, 
+                    hash_funcs: list=None,
+                    band_size: int=BAND_SIZE,
+                    threshold: float=THRESHOLD,
+                    workers: int=1,
+                    use_cache: bool=False):
+  """Match a stream of probe documents against a reference library.
+
+  Only the reference documents are indexed, in a BandIndex, so the memory is 
+  that of the reference signatures and band tables, and the pairs of probe 
+  documents are never generated. The probe documents are signed with the same
+  hash functions and looked up one after the other. The reference documents 
+  sharing a band with a probe are verified with the exact Jaccard of their 
+  shingles, which are read again (from the cache with use_cache) only for the
+  documents with candidates.
+
+  Args:
+    reference_files: paths of the reference documents
+    probe_files: paths of the probe documents, may be a generator
+    hash_funcs: hash functions used, HASH_FUNC_COUNT new MixedHash functions 
+                if not given
+    band_size: number of rows in a band
+    threshold: smallest Jaccard similarity reported
+    workers: number of processes signing the documents
+    use_cache: use the cache of shingle_cache for the parsed documents
+
+  Yields:
+    Tuples (probe, reference, similarity) of the index of a probe document, 
+    the index of a reference document sharing a band with it and their exact 
+    Jaccard similarity, by decreasing similarity for every probe
+  """
+  if hash_funcs is None:
+    hash_funcs = get_hash_funcs(mixed=True)
+
+  reference = ingest_signatures(reference_files, hash_funcs, workers, 
+                                use_cache)
+  keys = band_hashes(reference, band_size)
+  index = BandIndex(keys.shape[1])
+  for doc in range(0, len(reference)):
+    index.add(doc, keys[doc])
+
+  # Paths of the probe documents submitted and not yet yielded
+  pending = collections.deque()
+  def stream():
+    for f in probe_files:
+      pending.append(f)
+      yield f
+
+  shingles = {}
+  rows = iter_signatures(stream(), hash_funcs, workers, use_cache)
+  for probe, row in enumerate(rows):
+    f = pending.popleft()
+    candidates = sorted(index.query(band_hashes(row[None], band_size)[0]))
+    if not candidates:
+      continue
+
+    ids = get_document(f, use_cache)[1]
+    scored = []
+    for doc in candidates:
+      if doc not in shingles:
+        shingles[doc] = get_document(reference_files[doc], use_cache)[1]
+      similarity = exact_jaccard(ids, shingles[doc])
+      if similarity >= threshold:
+        scored.append((probe, doc, similarity))
+
+    scored.sort(key=lambda match: -match[2])
+    yield from scored
+
+
+def get_band_buckets(keys: np.ndarray) -> list:
+  """Group the documents by the key of one band.
+
+  Args:
+    keys: key of the band of every document
+
+  Returns:
+    List of arrays of the sorted indices of the documents in every bucket
+    containing more than one document
+  """
+  order = np.argsort(keys, kind="stable")
+  starts = np.flatnonzero(np.diff(keys[order]) != 0) + 1
+  return [bucket for bucket in np.split(order, starts) if len(bucket) > 1]
+
+
+def exact_jaccard(x: np.ndarray, y: np.ndarray) -> float:
+  """Jaccard similarity of two sorted arrays of distinct shingle ids.
+
+  The shingles of the smaller array are looked up in the larger one by binary
+  search, in O(m log n) for sizes m <= n.
+  """
+  if len(x) > len(y):
+    x, y = y, x
+  if len(y) == 0:
+    return 1.0
+
+  index = np.searchsorted(y, x)
+  index[index == len(y)] = 0
+  common = int(np.count_nonzero(y[index] == x))
+  return common / (len(x) + len(y) - common)
 
-  return candidate_pairs
 
-def main():
-  files = get_files()
-  shingles = get_shingles(files)
-  matrix = create_signature_matrix(shingles)
+def verify_candidates(candidate_pairs, 
+                      shingles: list, 
+                      threshold: float=THRESHOLD) -> list:
+  """Keep the candidate pairs of an exact Jaccard similarity of at least 
+  threshold.
+
+  Args:
+    candidate_pairs: pairs (i, j) of indices of documents
+    shingles: sorted distinct shingle ids of every document, see 
+              get_shingle_arrays
+    threshold: smallest Jaccard similarity kept
+
+  Returns:
+    List of the tuples (i, j, similarity), by decreasing similarity
+  """
+  scored = []
+  for i, j in candidate_pairs:
+    similarity = exact_jaccard(shingles[i], shingles[j])
+    if similarity >= threshold:
+      scored.append((i, j, similarity))
+
+  scored.sort(key=lambda pair: (-pair[2], pair[0], pair[1]))
+  return scored
+
+
+def main(reference_folder: str=None, probe_folder: str=None):
+  """Print the similar documents of the probe folder and the reference folder,
+  or the similar pairs of documents of the reference folder (DATA_FOLDER if 
+  not given) if there is no probe folder.
+  """
+  if probe_folder is not None:
+    reference_files = get_files(Path(reference_folder))
+    probe_files = get_files(Path(probe_folder))
+    for probe, reference, similarity in similarity_join(
+        reference_files, probe_files, workers=os.cpu_count(), use_cache=True):
+      print(probe_files[probe], reference_files[reference], similarity)
+    return
+
+  files = get_files(DATA_FOLDER if reference_folder is None 
+                    else Path(reference_folder))
+  matrix = ingest_signatures(files, get_hash_funcs(mixed=True), 
+                             workers=os.cpu_count(), use_cache=True)
   candidate_pairs = get_candidate_pair(matrix)
-  print(candidate_pairs)
+  shingles = get_shingle_arrays(files, use_cache=True)
+  for i, j, similarity in verify_candidates(candidate_pairs, shingles):
+    print(files[i], files[j], similarity)
 
 if __name__ == "__main__":
-  main()
+  main(*sys.argv[1:])
+
+
+def test_shingle_ids():
+  """Check if the rolling shingles are the same as the ones of 
+  preprocess_shingles.
+  """
+  chars = ACCEPTABLE_CHARS + ['A', '%', '\n', '€', '😀']
+  for l in [0, 1, SHINGLE_SIZE - 1, SHINGLE_SIZE, 200]:
+    content = "".join(random.choice(chars) for i in range(0, l))
+    expected = [preprocess_shingles(content[i:i + SHINGLE_SIZE]) 
+                for i in range(0, l - SHINGLE_SIZE + 1)]
+    assert list(iter_shingles(content)) == expected
+    assert shingle_ids(content).tolist() == expected
+
+def test_build_signature_matrix():
+  """Check if the vectorized signature matrix is the same as the one of 
+  create_signature_matrix.
+  """
+  data = [set(), {0, 1}]
+  for i in range(0, 5):
+    l = random.randint(1, 300)
+    data.append({random.randrange(pow(64, SHINGLE_SIZE)) for j in range(l)})
+
+  for mixed in (False, True):
+    hash_funcs = get_hash_funcs(mixed=mixed)
+    expected = create_signature_matrix(data, hash_funcs)
+    matrix = build_signature_matrix(data, hash_funcs, chunk_size=7)
+    assert matrix.dtype == np.uint32
+    for row, expected_row in zip(matrix.tolist(), expected):
+      assert row == [EMPTY_SIGNATURE if v == float('inf') else v 
+                     for v in expected_row]
+
+def test_candidate_pair():
+  """Check if the candidate pairs are the pairs of documents with an equal band.
+  """
+  matrix = [[random.randrange(3) for j in range(0, HASH_FUNC_COUNT)] 
+            for i in range(0, 40)]
+  matrix.append([float('inf')] * HASH_FUNC_COUNT)
+  matrix.append([float('inf')] * HASH_FUNC_COUNT)
+
+  expected = set()
+  for i in range(0, len(matrix)):
+    for j in range(i + 1, len(matrix)):
+      for b in range(0, HASH_FUNC_COUNT, BAND_SIZE):
+        if matrix[i][b:b + BAND_SIZE] == matrix[j][b:b + BAND_SIZE]:
+          expected.add((i, j))
+
+  assert get_candidate_pair(matrix) == expected
+  assert get_candidate_pair(np.array(matrix[:40], dtype=np.uint32)) == {
+    (i, j) for i, j in expected if j < 40}
+
+def test_ingest_signatures(tmp_path):
+  """Check if the signatures computed in a process pool are the same as the 
+  ones computed from the shingles of the files.
+  """
+  files = []
+  for i in range(0, 4):
+    document = Document()
+    for j in range(0, 3):
+      document.add_paragraph("".join(random.choice(ACCEPTABLE_CHARS) 
+                                     for k in range(0, 50)))
+    files.append(str(tmp_path / f"{i}.docx"))
+    document.save(files[-1])
+
+  hash_funcs = get_hash_funcs()
+  expected = build_signature_matrix(get_shingles(files), hash_funcs)
+  assert (ingest_signatures(files, hash_funcs) == expected).all()
+  assert (ingest_signatures(files, hash_funcs, workers=2) == expected).all()
+
+def test_verify_candidates():
+  """Check the exact Jaccard of sorted arrays against the one of sets.
+  """
+  rand = random.Random(3)
+  shingles = [sorted(rand.sample(range(0, 300), rand.randint(0, 200)))
+              for i in range(0, 12)]
+  arrays = [np.array(x, dtype=np.uint32) for x in shingles]
+  pairs = list(itertools.combinations(range(0, 12), 2))
+  for i, j in pairs:
+    x, y = set(shingles[i]), set(shingles[j])
+    expected = len(x & y) / len(x | y) if x | y else 1.0
+    assert exact_jaccard(arrays[i], arrays[j]) == expected
+
+  scored = verify_candidates(pairs, arrays, 0.3)
+  assert all(similarity >= 0.3 for i, j, similarity in scored)
+  assert len(scored) == sum(exact_jaccard(arrays[i], arrays[j]) >= 0.3 
+                            for i, j in pairs)
+  assert scored == sorted(scored, key=lambda pair: -pair[2])
+
+def test_similarity_join(tmp_path):
+  """Check if the join finds the reference copies of the probe documents and 
+  no pair inside a side.
+  """
+  texts = [" ".join(random.choice(["alpha", "beta", "gamma", "delta", "pi"])
+                    for i in range(0, 300)) for j in range(0, 4)]
+  files = []
+  for j, text in enumerate(texts + texts[:2]):
+    document = Document()
+    document.add_paragraph(text)
+    document.save(tmp_path / f"{j}.docx")
+    files.append(str(tmp_path / f"{j}.docx"))
+
+  hash_funcs = get_hash_funcs(20, mixed=True)
+  matches = list(similarity_join(files[:4], iter(files[4:]), hash_funcs, 
+                                 threshold=0.0, workers=2))
+  assert (0, 0, 1.0) in matches and (1, 1, 1.0) in matches
+  assert all(probe < 2 and reference < 4 for probe, reference, s in matches)
+
+  shingles = get_shingle_arrays(files)
+  for probe, reference, similarity in matches:
+    assert similarity == exact_jaccard(shingles[4 + probe], shingles[reference])
+
+  # Unrelated novels of Jaccard about 0.3
+  novels = [str(DATA_FOLDER / "timemach.docx"), 
+            str(DATA_FOLDER / "3_-_the_titan_s_curse.docx")]
+  assert list(similarity_join(novels[:1], novels[1:], hash_funcs)) == []
+
+def test_iter_signatures_stream(tmp_path):
+  """Check if an unbounded stream of files is read only as the rows are 
+  consumed.
+  """
+  files = []
+  for j in range(0, 3):
+    document = Document()
+    document.add_paragraph(" ".join(str(random.random()) for i in range(50)))
+    document.save(tmp_path / f"{j}.docx")
+    files.append(str(tmp_path / f"{j}.docx"))
+
+  consumed = []
+  def stream():
+    for f in itertools.cycle(files):
+      consumed.append(f)
+      yield f
+
+  hash_funcs = get_hash_funcs(10)
+  expected = build_signature_matrix([get_document(f)[1] for f in files], 
+                                    hash_funcs)
+  rows = iter_signatures(stream(), hash_funcs, workers=2)
+  for j, row in enumerate(itertools.islice(rows, 5)):
+    assert (row == expected[j % 3]).all()
+  assert len(consumed) <= 5 + WINDOW_FACTOR * 2
+  rows.close()
+
+def test_one_permutation_hash():
+  """Check if one permutation hashing gives dense signatures which estimate the
+  Jaccard similarity.
+  """
+  hash_funcs = get_hash_funcs(256, one_permutation=True)
+  x = set(range(0, 3000))
+  y = set(range(1000, 4000))
+  matrix = build_signature_matrix([x, y, set(), {7}, x], hash_funcs)
+  assert matrix.shape == (5, 256) and matrix.dtype == np.uint32
+  assert (matrix[2] == EMPTY_SIGNATURE).all()
+  assert (matrix[3] == matrix[3][0]).all()
+  assert (matrix[0] == matrix[4]).all()
+  assert abs((matrix[0] == matrix[1]).mean() - 0.5) < 0.15
+  assert (0, 4) in get_candidate_pair(matrix)
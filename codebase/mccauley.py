@@ -1,10 +1,17 @@
-from   hash_family import HashFamily, get_p_values
-from   nltk.corpus import words
-from   Levenshtein import editops
-from   pathlib     import Path
+from   concurrent.futures import ProcessPoolExecutor
+from   hash_bank          import get_bank_families, load_bank
+from   hash_family        import HashFamily, fingerprint_bank, get_p_values
+from   hash_family        import fingerprint_collisions, fingerprint_trie
+from   hash_family        import fingerprint_transcript, get_seeds, mix64
+from   mccauley_index     import CompactIndex
+from   nltk.corpus        import words
+from   pathlib            import Path
+from   verification       import bounded_distances, edit_distance
+import heapq
 import math
 import os
 import random
+import sys
 
 # Assuming that all the documents have a size less than 2^15
 MAX_STRING_SIZE = 25
@@ -21,6 +28,33 @@ R_VALUE = 2
 C_VALUE = 10
 # Number of hash functions used = O(1/p1), where p1=p^r-2/n^2
 NUM_HASH_FUNC = math.ceil(1/P_VALUE**R_VALUE - (2/NUM_STRINGS**2))
+# Largest number of strings in a bucket, the larger ones are split or skipped
+MAX_BUCKET_SIZE = 32
+# Mixed with the seed of a hash function to get the seed of its secondary hash
+SPLIT_SEED = 0x3C6EF372FE94F82B
+# Marker of a bucket skipped during the queries because it is overfull
+SKIPPED = frozenset()
+# Number of hash functions of the fingerprint collision report of main
+COLLISION_SAMPLE = 10
+
+
+class SplitBucket(dict):
+  """Overfull bucket split by the transcripts of a secondary hash function.
+
+  The keys are the transcripts (or fingerprints) of the secondary hash function
+  rho and the values are the sets of words, as in the buckets of hash_strs.
+  """
+
+  def __init__(self, rho: HashFamily):
+    super().__init__()
+    self.rho = rho
+
+  def get_words(self, query: str, fingerprint: bool=False) -> set:
+    """Words of the sub-bucket of the query.
+    """
+    key = (self.rho.fingerprint_str(query) if fingerprint 
+           else self.rho.hash_str(query))
+    return self.get(key, SKIPPED)
 
 
 def get_words() -> list:
@@ -47,63 +81,254 @@ def get_all_words() -> list:
   return word_list
 
 
-def hash_strs(words: list) -> dict:
+def hash_strs(words: list, seed: int=None, fingerprint: bool=False) -> dict:
   """Hash all the strings in the list based on the hash function.
 
   Args:
-    text: list of strings
+    text:        list of strings
+    seed:        seed of the hash function, a random one is drawn if not given
+    fingerprint: key the buckets by the 64 bit fingerprint of the transcript 
+                 instead of the transcript itself
 
   Returns:
     Dict of list of file index containing the key as hashed_str and
     an object of the HashFamily class
   """
   # Define the hash function
+  if seed is None:
+    seed = random.getrandbits(64)
   pa, pr = get_p_values()
-  rho = HashFamily(pa, pr)
+  rho = HashFamily(pa, pr, seed=seed)
 
   # Get the hash values
-  hash_values = {}
-  
-  for string in words:
-    hashed_str = rho.hash_str(string)
+  hash_values = get_word_buckets(get_buckets(rho, words, fingerprint), words)
+
+  return (hash_values, rho)
+
 
+def get_buckets(rho: HashFamily, words: list, fingerprint: bool=False) -> dict:
+  """Group the ids of the strings by their hash value.
+
+  Args:
+    rho:         object of the HashFamily class
+    words:       list of strings
+    fingerprint: key the buckets by the fingerprints of the transcripts
+
+  Returns:
+    Dict with key as the hashed_str and value as the list of ids of the strings
+  """
+  buckets = {}
+  for i, hashed_str in enumerate(rho.hash_many(words, fingerprint=fingerprint)):
     # We consider the string only if its transcript is complete.
-    if hashed_str != "NOT-COMPLETE":
-      if hashed_str in hash_values:
-        hash_values[hashed_str].add(string)
+    if hashed_str is not None and hashed_str != "NOT-COMPLETE":
+      if hashed_str in buckets:
+        buckets[hashed_str].append(i)
       else:
-        hash_values[hashed_str] = {string}
+        buckets[hashed_str] = [i]
 
-  return (hash_values, rho)
+  return buckets
 
 
-def get_hash_values(words: list, hash_func: int=NUM_HASH_FUNC) -> set:
+def get_hash_values(words: list, 
+                    hash_func: int=NUM_HASH_FUNC, 
+                    fingerprint: bool=False,
+                    seed: int=None,
+                    workers: int=1,
+                    families: list=None,
+                    max_bucket: int=None,
+                    split: bool=True) -> set:
   """Traverse through all the words for NUM_HASH_FUNC times and generate a 
   dictionary used to compare the queries later.
 
+  The seed of every hash function is derived from the master seed, so the 
+  dictionary is the same for a given seed whatever the number of workers. With
+  more than one worker, shards of the hash functions are hashed in a process 
+  pool and only the buckets, as lists of ids, are sent back.
+
   Args:
     words: list of all the words
     hash_func: number of hash functions used
+    fingerprint: key the buckets by the fingerprints of the transcripts
+    seed: master seed, a random one is drawn if not given
+    workers: number of processes used to build the buckets
+    families: use these hash functions, e.g. from a bank of hash_bank, instead
+              of hash_func new ones
+    max_bucket: largest number of strings in a bucket, see cap_buckets. The
+                buckets are not capped if not given.
+    split: split the overfull buckets instead of skipping them
 
   Returns:
     Dictionary of hash function and the hash values.
   """
+  if families is None:
+    families = get_families(hash_func, seed)
+
   # Dictionary with keys as the hash function rho and value as the buckets.
   hash={}
-  for i in range(0, hash_func):
-    hash_values, rho = hash_strs(words)
-    hash[rho] = hash_values
-  
+  if workers <= 1:
+    for rho in families:
+      hash[rho] = get_word_buckets(get_buckets(rho, words, fingerprint), words)
+  else:
+    shard_size = math.ceil(len(families) / workers)
+    shards = [range(i, min(i + shard_size, len(families))) 
+              for i in range(0, len(families), shard_size)]
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_worker,
+                             initargs=(words, families, fingerprint)) as pool:
+      for shard in pool.map(hash_shard, shards):
+        for f, buckets in shard:
+          hash[families[f]] = get_word_buckets(buckets, words)
+
+  if max_bucket is not None:
+    cap_buckets(hash, max_bucket, split, fingerprint)
+
   return hash
 
 
-def process_query(query: str, hash: dict) -> list:
+def cap_buckets(hash: dict, 
+                max_bucket: int=MAX_BUCKET_SIZE, 
+                split: bool=True,
+                fingerprint: bool=False):
+  """Bound the number of strings a query can get from a single bucket.
+
+  Short strings or small values of pa and pr send many strings to the same 
+  transcript, e.g. runs of the bottom symbol, and a query falling in such a 
+  bucket would get most of the database as candidates. Every bucket of more 
+  than max_bucket strings is either split by a secondary hash function, derived
+  from the seed of the primary one, or replaced by SKIPPED. The sub-buckets 
+  still over max_bucket are skipped. The buckets are changed in place.
+
+  Args:
+    hash: the dictionary of all the hash_functions and corresponding buckets
+    max_bucket: largest number of strings in a bucket
+    split: split the overfull buckets instead of skipping them
+    fingerprint: the buckets are keyed by the fingerprints of the transcripts
+  """
+  for rho, buckets in hash.items():
+    for key, bucket in buckets.items():
+      if len(bucket) <= max_bucket:
+        continue
+      buckets[key] = SKIPPED
+      if split:
+        buckets[key] = split_bucket(rho, bucket, max_bucket, fingerprint)
+
+
+def split_bucket(rho: HashFamily, 
+                 bucket: set, 
+                 max_bucket: int=MAX_BUCKET_SIZE,
+                 fingerprint: bool=False) -> SplitBucket:
+  """Split the words of an overfull bucket of rho by a secondary hash function.
+
+  Args:
+    rho: the hash function of the bucket
+    bucket: set of words of the bucket
+    max_bucket: largest number of strings in a sub-bucket, the larger ones are
+                skipped
+    fingerprint: key the sub-buckets by the fingerprints of the transcripts
+
+  Returns:
+    Object of the SplitBucket class
+  """
+  seed = random.getrandbits(64) if rho.seed is None else rho.seed
+  secondary = HashFamily(rho.pa, 
+                         rho.pr, 
+                         str_len=rho.str_len,
+                         num_strings=rho.num_strings,
+                         alphabet=rho.alphabet,
+                         seed=mix64(seed ^ SPLIT_SEED))
+
+  split = SplitBucket(secondary)
+  words = sorted(bucket)
+  buckets = get_word_buckets(get_buckets(secondary, words, fingerprint), words)
+  for key, sub_bucket in buckets.items():
+    split[key] = sub_bucket if len(sub_bucket) <= max_bucket else SKIPPED
+
+  return split
+
+
+def get_bucket_stats(hash: dict) -> dict:
+  """Statistics of the sizes of the buckets.
+
+  Args:
+    hash: the dictionary of all the hash_functions and corresponding buckets
+
+  Returns:
+    Dictionary of the number of buckets, of split and skipped buckets, and of 
+    the largest and mean number of strings a query can get from a bucket
+  """
+  sizes = []
+  split = 0
+  skipped = 0
+  for buckets in hash.values():
+    for bucket in buckets.values():
+      if isinstance(bucket, SplitBucket):
+        split += 1
+        skipped += sum(sub_bucket is SKIPPED for sub_bucket in bucket.values())
+        sizes.extend(len(sub_bucket) for sub_bucket in bucket.values()
+                     if sub_bucket is not SKIPPED)
+      elif bucket is SKIPPED:
+        skipped += 1
+      else:
+        sizes.append(len(bucket))
+
+  return {"buckets": len(sizes),
+          "split": split,
+          "skipped": skipped,
+          "max_size": max(sizes, default=0),
+          "mean_size": sum(sizes) / len(sizes) if sizes else 0}
+
+
+def get_families(hash_func: int=NUM_HASH_FUNC, seed: int=None) -> list:
+  """Seeded hash functions derived from a master seed.
+
+  Args:
+    hash_func: number of hash functions
+    seed: master seed, a random one is drawn if not given
+
+  Returns:
+    List of objects of the HashFamily class
+  """
+  if seed is None:
+    seed = random.getrandbits(64)
+  pa, pr = get_p_values()
+  return [HashFamily(pa, pr, seed=s) for s in get_seeds(seed, hash_func)]
+
+
+def get_word_buckets(buckets: dict, words: list) -> dict:
+  """Replace the ids in the buckets of get_buckets by the sets of words.
+  """
+  return {hashed_str: {words[i] for i in ids} 
+          for hashed_str, ids in buckets.items()}
+
+
+def init_worker(words: list, families: list, fingerprint: bool):
+  """Store the arguments shared by all the shards in the worker process.
+  """
+  global WORKER_ARGS
+  WORKER_ARGS = (words, families, fingerprint)
+
+
+def hash_shard(shard: range) -> list:
+  """Build the buckets of the hash functions of a shard in a worker process.
+
+  Args:
+    shard: indices of the hash functions
+
+  Returns:
+    List of tuples of the index and the buckets of every hash function
+  """
+  words, families, fingerprint = WORKER_ARGS
+  return [(f, get_buckets(families[f], words, fingerprint)) for f in shard]
+
+
+def process_query(query: str, hash: dict, fingerprint: bool=False) -> list:
   """Hash the query based on all the hash functions rho and return the words 
   which match to the same bucket as the query.
 
   Args:
     query: the query string which we compare to all the words
     hash: the dictionary of all the hash_functions and corresponding buckets
+    fingerprint: the buckets are keyed by the fingerprints of the transcripts
 
   Returns:
     A list of all the words which have similar hash as the query, which inturn
@@ -111,24 +336,79 @@ def process_query(query: str, hash: dict) -> list:
   """
   similar_words = set()
   for rho in hash:
-    bucket = rho.hash_str(query)
+    bucket = rho.fingerprint_str(query) if fingerprint else rho.hash_str(query)
     if bucket in hash[rho]:
-      for j in hash[rho][bucket]:
+      bucket = hash[rho][bucket]
+      if isinstance(bucket, SplitBucket):
+        bucket = bucket.get_words(query, fingerprint)
+      for j in bucket:
         similar_words.add(j)
 
   return similar_words
 
 
-def main():
+def process_queries(queries: list, 
+                    hash: dict, 
+                    k: int=10, 
+                    max_ed: int=C_VALUE * R_VALUE,
+                    fingerprint: bool=False) -> tuple:
+  """Process a batch of queries and return the closest words to each of them.
+
+  All the queries are hashed by every hash function in one pass, the words 
+  which share a bucket with a query are collected as its candidates, and the 
+  candidates are verified with the bounded edit distance of verification.
+
+  Args:
+    queries: list of query strings
+    hash: the dictionary of all the hash_functions and corresponding buckets
+    k: maximum number of words returned for each query
+    max_ed: words at an edit distance larger than max_ed are discarded
+    fingerprint: the buckets are keyed by the fingerprints of the transcripts
+
+  Returns:
+    Tuple of the results and the candidate counts. The results contain, for 
+    every query, a list of at most k tuples (word, edit distance) sorted by 
+    distance. The candidate counts contain the number of distinct candidates of
+    every query.
+  """
+  candidates = [set() for query in queries]
+  for rho, buckets in hash.items():
+    hashed = rho.hash_many(queries, fingerprint=fingerprint)
+    for q, bucket in enumerate(hashed):
+      if bucket in buckets:
+        bucket = buckets[bucket]
+        if isinstance(bucket, SplitBucket):
+          bucket = bucket.get_words(queries[q], fingerprint)
+        candidates[q].update(bucket)
+
+  results = []
+  counts = []
+  for query, similar_words in zip(queries, candidates):
+    counts.append(len(similar_words))
+    similar_words = list(similar_words)
+    distances = bounded_distances([(query, w) for w in similar_words], max_ed)
+    scored = [(ed, word) for ed, word in zip(distances, similar_words) 
+              if ed <= max_ed]
+    results.append([(word, ed) for ed, word in heapq.nsmallest(k, scored)])
+
+  return (results, counts)
+
+
+def main(bank_id: str=None):
   words = get_words()
-  hash = get_hash_values(words)
+  families = get_families() if bank_id is None else load_bank(bank_id).families
+  index = CompactIndex.build(words, families, max_bucket=MAX_BUCKET_SIZE, 
+                             workers=os.cpu_count())
+  print(index.get_bucket_stats())
+  print(fingerprint_collisions(families[:COLLISION_SAMPLE], words))
   query = get_random_word()
-  similar_words = process_query(query, hash)
-  print(f"Words similar to {query} are: \n{similar_words}")
+  results, counts = index.process_queries([query])
+  print(f"Words similar to {query} out of {counts[0]} candidates are: \n"
+        f"{results[0]}")
 
 
 if __name__ == "__main__":
-  main()
+  main(*sys.argv[1:])
 
 def test_pa_values():
   """Check if the pa values lie in (0,1/2]
@@ -177,4 +457,183 @@ def test_same_string():
   hash = get_hash_values(word_list, 1)
   similar = process_query(random.choice(word_list), hash)
   assert len(similar) > 0
- 
\ No newline at end of file
+ 
+def test_hash_many():
+  """Check if hashing a batch of strings gives the same values as hashing them 
+  one at a time.
+  """
+  rho = HashFamily()
+  strings = [""]
+  for i in range(0, 50):
+    l = random.randint(1, 30)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS) for j in range(l)))
+
+  assert rho.hash_many(strings, batch_size=16) == [rho.hash_str(x) 
+                                                   for x in strings]
+
+def test_seeded_rho():
+  """Check if a seeded hash function gives the same hash values in the scalar 
+  and batch paths, and if it can be rebuilt from its seed.
+  """
+  pa, pr = get_p_values()
+  seed = random.getrandbits(64)
+  rho = HashFamily(pa, pr, seed=seed)
+  strings = []
+  for i in range(0, 50):
+    l = random.randint(1, 30)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS) for j in range(l)))
+
+  hashed = rho.hash_many(strings)
+  assert hashed == [rho.hash_str(x) for x in strings]
+  assert hashed == HashFamily(pa, pr, seed=seed).hash_many(strings)
+
+def test_fingerprint_buckets():
+  """Check if keying the buckets by fingerprints gives the same buckets as 
+  keying them by the transcripts.
+  """
+  strings = []
+  for i in range(0, 50):
+    l = random.randint(1, 8)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS[:3]) 
+                           for j in range(l)))
+
+  seed = random.getrandbits(64)
+  buckets, rho = hash_strs(strings, seed)
+  fp_buckets, fp_rho = hash_strs(strings, seed, fingerprint=True)
+  assert (sorted(map(sorted, buckets.values())) == 
+          sorted(map(sorted, fp_buckets.values())))
+  for x in strings:
+    assert fp_rho.fingerprint_str(x) == fingerprint_transcript(rho.hash_str(x))
+
+def test_fingerprint_collisions():
+  """Check if the report counts no collision of the full fingerprints and the 
+  collisions of fingerprints truncated to a single bit.
+  """
+  strings = []
+  for i in range(0, 50):
+    l = random.randint(1, 8)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS[:3]) 
+                           for j in range(l)))
+
+  pa, pr = get_p_values(0.1)
+  families = [HashFamily(pa, pr, seed=s) for s in get_seeds(7, 5)]
+  transcripts = [set(rho.hash_many(strings)) - {"NOT-COMPLETE"} 
+                 for rho in families]
+  report = fingerprint_collisions(families, strings)
+  assert report["transcripts"] == sum(map(len, transcripts))
+  assert report["collisions"] == 0 and report["expected"] < 1e-15
+
+  # At most 2 distinct keys of 1 bit, so every other transcript collides
+  report = fingerprint_collisions(families, strings, bits=1)
+  assert report["collisions"] == sum(
+    len(t) - len({fingerprint_transcript(s) & 1 for s in t}) 
+    for t in transcripts)
+  assert report["collisions"] >= report["transcripts"] - 2 * len(families) > 0
+
+def test_parallel_hash_values():
+  """Check if building the buckets in a process pool gives the same hash 
+  functions and buckets as building them in a single process.
+  """
+  strings = []
+  for i in range(0, 50):
+    l = random.randint(1, 8)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS[:3]) 
+                           for j in range(l)))
+
+  seed = random.getrandbits(64)
+  serial = get_hash_values(strings, 10, seed=seed)
+  parallel = get_hash_values(strings, 10, seed=seed, workers=3)
+  assert ([(rho.seed, buckets) for rho, buckets in serial.items()] == 
+          [(rho.seed, buckets) for rho, buckets in parallel.items()])
+
+def test_process_queries():
+  """Check if the batched queries return the closest candidates of every query 
+  in sorted order.
+  """
+  strings = []
+  for i in range(0, 50):
+    l = random.randint(1, 8)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS[:3]) 
+                           for j in range(l)))
+
+  hash = get_hash_values(strings, 10)
+  queries = random.sample(strings, 5) + ["abcab"]
+  results, counts = process_queries(queries, hash, k=3, max_ed=2)
+  for query, result, count in zip(queries, results, counts):
+    similar = process_query(query, hash)
+    expected = sorted((edit_distance(query, w), w) for w in similar 
+                      if edit_distance(query, w) <= 2)
+    assert count == len(similar)
+    assert result == [(w, ed) for ed, w in expected[:3]]
+
+def test_fingerprint_bank(tmp_path):
+  """Check if the fingerprints of a bank of hash functions are the same as the 
+  fingerprints computed by every hash function.
+  """
+  strings = [""]
+  for i in range(0, 30):
+    l = random.randint(1, 30)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS) for j in range(l)))
+
+  families = get_bank_families(0.3, ACCEPTABLE_CHARS, MAX_STRING_SIZE, 
+                               NUM_STRINGS, 20, seed=7, folder=tmp_path)
+  fps, complete = fingerprint_bank(families, strings, batch_size=100)
+  for f, rho in enumerate(families):
+    expected_fps, expected_complete = rho.fingerprint_many(strings)
+    assert (complete[f] == expected_complete).all()
+    assert (fps[f][expected_complete] == expected_fps[expected_complete]).all()
+
+def test_cap_buckets(tmp_path):
+  """Check if the overfull buckets are split or skipped and if the queries 
+  find the words of the sub-buckets.
+  """
+  # Fixed strings and hash functions, so that the bucket sizes do not depend 
+  # on P_VALUE
+  rand = random.Random(4)
+  strings = []
+  for i in range(0, 80):
+    l = rand.randint(1, 4)
+    strings.append("".join(rand.choice(ACCEPTABLE_CHARS[:3]) for j in range(l)))
+  families = get_bank_families(0.1, ACCEPTABLE_CHARS, MAX_STRING_SIZE, 
+                               NUM_STRINGS, 10, seed=4, folder=tmp_path)
+  for fingerprint in (False, True):
+    full = get_hash_values(strings, fingerprint=fingerprint, families=families)
+    split = get_hash_values(strings, fingerprint=fingerprint, 
+                            families=families, max_bucket=1)
+    skip = get_hash_values(strings, fingerprint=fingerprint, 
+                           families=families, max_bucket=1, split=False)
+
+    assert get_bucket_stats(full)["max_size"] > 1
+    assert get_bucket_stats(split)["max_size"] <= 1
+    assert get_bucket_stats(split)["split"] > 0
+    assert get_bucket_stats(skip)["max_size"] <= 1
+    assert get_bucket_stats(skip)["skipped"] > 0
+    assert get_bucket_stats(skip)["split"] == 0
+
+    for query in set(strings):
+      expected = process_query(query, full, fingerprint)
+      for capped in (split, skip):
+        similar = process_query(query, capped, fingerprint)
+        assert similar <= expected and len(similar) <= 10
+        results, counts = process_queries([query], capped, k=100, 
+                                          fingerprint=fingerprint)
+        assert counts[0] == len(similar)
+
+def test_fingerprint_trie(tmp_path):
+  """Check if sharing the common prefixes gives the same fingerprints as 
+  fingerprint_bank, including the strings with an incomplete transcript.
+  """
+  strings = ["", "a", ""]
+  for i in range(0, 60):
+    l = random.randint(1, 60)
+    strings.append("".join(random.choice(ACCEPTABLE_CHARS[:3]) 
+                           for j in range(l)))
+  strings += [x + "ab" for x in strings[:20]] + strings[:5]
+
+  # Short strings in the bank, so that some transcripts are incomplete
+  families = get_bank_families(0.1, ACCEPTABLE_CHARS, 2, NUM_STRINGS, 7, 
+                               seed=5, folder=tmp_path)
+  fps, complete = fingerprint_bank(families, strings)
+  trie_fps, trie_complete = fingerprint_trie(families, strings, batch_size=100)
+  assert (trie_complete == complete).all() and not complete.all()
+  assert (trie_fps[complete] == fps[complete]).all()
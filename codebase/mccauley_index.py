@@ -0,0 +1,511 @@
+"""
+Flat, memory-mapped file format of the McCauley index.
+
+The strings of the database are interned once in a table and the buckets of 
+every hash function are stored as flat arrays: the sorted fingerprints of the 
+transcripts, the offsets of every bucket and the int32 ids of the strings in the
+bucket. CompactIndex.build computes the arrays directly from the fingerprints of
+hash_family.fingerprint_bank, with one sort per hash function. The hash 
+functions are stored as their seeds, so loading an index only maps the file in 
+memory and no bucket is rebuilt. Processes loading the same file share one copy
+of it through the page cache.
+
+Layout of the file:
+  MAGIC | header size (uint64) | JSON header | arrays aligned to ALIGNMENT
+"""
+from   concurrent.futures import ProcessPoolExecutor
+from   hash_bank          import get_bank_families
+from   hash_family        import HashFamily, fingerprint_bank
+from   hash_family        import fingerprint_trie
+from   hash_family        import fingerprint_transcript
+from   verification       import bounded_distances
+import heapq
+import itertools
+import json
+import math
+import numpy as np
+import random
+
+MAGIC = b"MCINDEX1"
+# Alignment in bytes of every array in the file.
+ALIGNMENT = 64
+# Largest edit distance of the results, C_VALUE * R_VALUE of mccauley
+MAX_EDIT_DISTANCE = 20
+# Number of (hash function, string) fingerprints computed at once by 
+# build_tables
+BUILD_LANES = pow(2, 22)
+
+
+class CompactIndex:
+  """McCauley index stored in flat arrays.
+
+  The index contains num_func hash functions. The fingerprints of the buckets 
+  of the fth hash function are keys[tables[f]:tables[f+1]] in sorted order, and 
+  the ids of the strings in the kth bucket are ids[offsets[k]:offsets[k+1]].
+  The ids refer to the table of strings words.
+  """
+
+  def __init__(self, 
+               words: list, 
+               families: list, 
+               tables: np.ndarray, 
+               keys: np.ndarray, 
+               offsets: np.ndarray, 
+               ids: np.ndarray):
+    """Initialise the class
+    Args:
+        words:    list of the strings in the database
+        families: list of the seeded hash functions
+        tables:   start of the buckets of every hash function in keys
+        keys:     fingerprints of the buckets
+        offsets:  start of every bucket in ids
+        ids:      ids of the strings in the buckets
+    """
+    self.words = words
+    self.families = families
+    self.tables = tables
+    self.keys = keys
+    self.offsets = offsets
+    self.ids = ids
+
+  @classmethod
+  def from_hash_values(cls, words: list, hash: dict) -> "CompactIndex":
+    """Convert the dictionary built by mccauley.get_hash_values.
+
+    Args:
+      words: list of all the words
+      hash:  dictionary of the hash functions and their buckets, keyed either by
+             the transcripts or by their fingerprints. The skipped buckets of 
+             mccauley.cap_buckets are kept as empty buckets.
+
+    Returns:
+      Object of the CompactIndex class
+    """
+    word_ids = {}
+    for i, word in enumerate(words):
+      word_ids.setdefault(word, i)
+
+    tables = [0]
+    keys = []
+    offsets = [0]
+    ids = []
+    for rho, buckets in hash.items():
+      table = {}
+      for key, bucket in buckets.items():
+        if isinstance(bucket, dict):
+          raise ValueError("Split buckets of mccauley.cap_buckets are not "
+                           "supported, skip the overfull buckets instead")
+        if isinstance(key, str):
+          key = fingerprint_transcript(key)
+        table[key] = sorted(word_ids[word] for word in bucket)
+
+      for key in sorted(table):
+        keys.append(key)
+        ids.extend(table[key])
+        offsets.append(len(ids))
+      tables.append(len(keys))
+
+    return cls(list(words), 
+               list(hash), 
+               np.array(tables, dtype=np.int64),
+               np.array(keys, dtype=np.uint64),
+               np.array(offsets, dtype=np.int64),
+               np.array(ids, dtype=np.int32))
+
+  @classmethod
+  def build(cls, 
+            words: list, 
+            families: list, 
+            max_bucket: int=None,
+            workers: int=1,
+            trie: bool=False) -> "CompactIndex":
+    """Build the index directly from the fingerprints of the strings.
+
+    The strings are interned in a table of distinct strings, and the buckets of
+    every hash function are found by sorting the fingerprints of the strings, 
+    so no dictionary or set is built.
+
+    Args:
+      words:      list of all the words
+      families:   list of seeded hash functions sharing pa, pr and the alphabet
+      max_bucket: the buckets of more than max_bucket strings are kept empty,
+                  like the skipped buckets of mccauley.cap_buckets
+      workers:    number of processes, each one builds the buckets of a shard
+                  of the hash functions
+      trie:       fingerprint the strings with hash_family.fingerprint_trie, 
+                  faster when the strings share long prefixes
+
+    Returns:
+      Object of the CompactIndex class
+    """
+    words = list(dict.fromkeys(words))
+    shard_size = math.ceil(len(families) / max(workers, 1)) or 1
+    shards = [families[i:i + shard_size] 
+              for i in range(0, len(families), shard_size)]
+
+    if workers <= 1:
+      parts = [build_tables(shard, words, max_bucket, trie) for shard in shards]
+    else:
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(build_tables, shards, itertools.repeat(words), 
+                              itertools.repeat(max_bucket), 
+                              itertools.repeat(trie)))
+
+    tables = [np.zeros(1, dtype=np.int64)]
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for shard_tables, keys, shard_offsets, ids in parts:
+      tables.append(shard_tables[1:] + tables[-1][-1])
+      offsets.append(shard_offsets[1:] + offsets[-1][-1])
+
+    return cls(words, 
+               list(families),
+               np.concatenate(tables),
+               np.concatenate([part[1] for part in parts] + 
+                              [np.empty(0, dtype=np.uint64)]),
+               np.concatenate(offsets),
+               np.concatenate([part[3] for part in parts] + 
+                              [np.empty(0, dtype=np.int32)]))
+
+  def save(self, path: str):
+    """Write the index in a single file.
+
+    Args:
+      path: path of the file
+    """
+    if not self.families or any(rho.seed is None for rho in self.families):
+      raise ValueError("Only indexes of hash functions with a seed can be saved")
+
+    encoded = [word.encode("utf-8") for word in self.words]
+    arrays = {
+      "seeds": np.array([rho.seed for rho in self.families], dtype=np.uint64),
+      "tables": self.tables,
+      "keys": self.keys,
+      "offsets": self.offsets,
+      "ids": self.ids,
+      "word_offsets": np.cumsum([0] + [len(w) for w in encoded], 
+                                dtype=np.int64),
+      "word_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+    }
+
+    rho = self.families[0]
+    header = {
+      "pa": rho.pa,
+      "pr": rho.pr,
+      "str_len": rho.str_len,
+      "num_strings": rho.num_strings,
+      "alphabet": rho.alphabet,
+      "arrays": {},
+    }
+
+    # Place the arrays one after the other, the offsets are relative to the 
+    # end of the header.
+    position = 0
+    for name, array in arrays.items():
+      position = align(position)
+      header["arrays"][name] = [position, array.dtype.str, len(array)]
+      position += array.nbytes
+
+    encoded_header = json.dumps(header).encode("utf-8")
+    start = align(len(MAGIC) + 8 + len(encoded_header))
+    with open(path, "wb") as f:
+      f.write(MAGIC)
+      f.write(np.uint64(len(encoded_header)).tobytes())
+      f.write(encoded_header)
+      for name, array in arrays.items():
+        f.write(b"\0" * (start + header["arrays"][name][0] - f.tell()))
+        f.write(np.ascontiguousarray(array).tobytes())
+
+  @classmethod
+  def load(cls, path: str) -> "CompactIndex":
+    """Memory-map an index written by save.
+
+    Args:
+      path: path of the file
+
+    Returns:
+      Object of the CompactIndex class whose arrays are views of the file.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+      raise ValueError(f"{path} is not a McCauley index file")
+
+    size = int(data[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+    header_end = len(MAGIC) + 8 + size
+    header = json.loads(bytes(data[len(MAGIC) + 8:header_end]))
+    start = align(header_end)
+
+    arrays = {}
+    for name, (position, dtype, count) in header["arrays"].items():
+      dtype = np.dtype(dtype)
+      begin = start + position
+      arrays[name] = data[begin:begin + count * dtype.itemsize].view(dtype)
+
+    families = [HashFamily(header["pa"], 
+                           header["pr"], 
+                           str_len=header["str_len"],
+                           num_strings=header["num_strings"],
+                           alphabet=header["alphabet"],
+                           seed=int(seed)) 
+                for seed in arrays["seeds"]]
+    words = MappedStrings(arrays["word_bytes"], arrays["word_offsets"])
+
+    return cls(words, 
+               families, 
+               arrays["tables"], 
+               arrays["keys"], 
+               arrays["offsets"], 
+               arrays["ids"])
+
+  def get_bucket(self, f: int, key: int) -> np.ndarray:
+    """Get the ids of the strings in a bucket.
+
+    Args:
+      f:   index of the hash function
+      key: fingerprint of the bucket
+
+    Returns:
+      Array of the ids, empty if the bucket does not exist.
+    """
+    start, end = int(self.tables[f]), int(self.tables[f + 1])
+    k = start + int(np.searchsorted(self.keys[start:end], np.uint64(key)))
+    if k == end or self.keys[k] != key:
+      return self.ids[:0]
+
+    return self.ids[self.offsets[k]:self.offsets[k + 1]]
+
+  def process_query(self, query: str) -> set:
+    """Same as mccauley.process_query on the index.
+
+    Args:
+      query: the query string which we compare to all the words
+
+    Returns:
+      Set of all the words which are in the same bucket as the query for at 
+      least one hash function.
+    """
+    similar_words = set()
+    for f, rho in enumerate(self.families):
+      key = rho.fingerprint_str(query)
+      if key is not None:
+        for j in self.get_bucket(f, key):
+          similar_words.add(self.words[j])
+
+    return similar_words
+
+  def get_bucket_stats(self) -> dict:
+    """Statistics of the sizes of the buckets, as mccauley.get_bucket_stats.
+
+    The buckets kept empty by the max_bucket of build are counted as skipped.
+    """
+    sizes = np.diff(self.offsets)
+    kept = sizes[sizes > 0]
+    return {"buckets": len(kept),
+            "split": 0,
+            "skipped": int(np.count_nonzero(sizes == 0)),
+            "max_size": int(kept.max(initial=0)),
+            "mean_size": float(kept.mean()) if len(kept) else 0}
+
+  def get_candidates(self, queries: list) -> list:
+    """Ids of the strings sharing a bucket with every query.
+
+    The queries are fingerprinted by all the hash functions at once, their 
+    buckets are found with one binary search per hash function, and the ids of
+    all the buckets are gathered and deduplicated with array operations.
+
+    Args:
+      queries: list of query strings
+
+    Returns:
+      List of the sorted arrays of the ids of the candidates of every query
+    """
+    fps, complete = fingerprint_bank(self.families, queries)
+    query_index = []
+    buckets = []
+    for f in range(0, len(self.families)):
+      start, end = int(self.tables[f]), int(self.tables[f + 1])
+      k = np.searchsorted(self.keys[start:end], fps[f])
+      found = complete[f] & (k < end - start)
+      found[found] = self.keys[start + k[found]] == fps[f][found]
+      query_index.append(np.flatnonzero(found))
+      buckets.append(start + k[found])
+
+    query_index = np.concatenate(query_index + [np.empty(0, dtype=np.int64)])
+    buckets = np.concatenate(buckets + [np.empty(0, dtype=np.int64)])
+    starts = self.offsets[buckets]
+    sizes = self.offsets[buckets + 1] - starts
+
+    # Position of every id of every bucket in ids
+    total = int(sizes.sum())
+    shift = np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+    ids = self.ids[shift + np.arange(0, total)].astype(np.int64)
+    pairs = np.unique(np.repeat(query_index, sizes) * len(self.words) + ids)
+
+    owners = pairs // max(len(self.words), 1)
+    bounds = np.searchsorted(owners, np.arange(0, len(queries) + 1))
+    candidates = pairs - owners * len(self.words)
+    return [candidates[bounds[q]:bounds[q + 1]] for q in range(0, len(queries))]
+
+  def process_queries(self, 
+                      queries: list, 
+                      k: int=10, 
+                      max_ed: int=MAX_EDIT_DISTANCE) -> tuple:
+    """Same as mccauley.process_queries on the index.
+
+    Args:
+      queries: list of query strings
+      k: maximum number of words returned for each query
+      max_ed: words at an edit distance larger than max_ed are discarded
+
+    Returns:
+      Tuple of the results, lists of at most k tuples (word, edit distance) 
+      sorted by distance, and the number of candidates of every query
+    """
+    results = []
+    counts = []
+    for query, ids in zip(queries, self.get_candidates(queries)):
+      counts.append(len(ids))
+      similar_words = [self.words[j] for j in ids.tolist()]
+      distances = bounded_distances([(query, w) for w in similar_words], max_ed)
+      scored = [(ed, word) for ed, word in zip(distances, similar_words) 
+                if ed <= max_ed]
+      results.append([(word, ed) for ed, word in heapq.nsmallest(k, scored)])
+
+    return (results, counts)
+
+
+class MappedStrings:
+  """Read-only list of strings stored as concatenated utf-8 bytes.
+  """
+
+  def __init__(self, data: np.ndarray, offsets: np.ndarray):
+    self.data = data
+    self.offsets = offsets
+
+  def __len__(self) -> int:
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i: int) -> str:
+    start, end = self.offsets[i], self.offsets[i + 1]
+    return bytes(self.data[start:end]).decode("utf-8")
+
+
+def build_tables(families: list, 
+                 words: list, 
+                 max_bucket: int=None,
+                 trie: bool=False) -> tuple:
+  """Flat arrays of the buckets of a shard of the hash functions.
+
+  The strings are fingerprinted by BUILD_LANES // len(words) hash functions at
+  a time, so the memory used on top of the arrays of the index does not depend
+  on the number of hash functions.
+
+  Args:
+    families:   list of seeded hash functions
+    words:      list of distinct strings
+    max_bucket: the buckets of more than max_bucket strings are kept empty
+    trie:       fingerprint the strings with hash_family.fingerprint_trie
+
+  Returns:
+    Tuple of the tables, keys, offsets and ids arrays of CompactIndex, for the
+    hash functions of the shard only
+  """
+  tables = [0]
+  keys = []
+  sizes = []
+  ids = []
+  # Only the fingerprints of a few hash functions are held at once
+  step = max(1, BUILD_LANES // max(len(words), 1))
+  for start in range(0, len(families), step):
+    fingerprint = fingerprint_trie if trie else fingerprint_bank
+    fps, complete = fingerprint(families[start:start + step], words)
+    for f in range(0, len(fps)):
+      valid = np.flatnonzero(complete[f])
+      order = valid[np.argsort(fps[f, valid], kind="stable")]
+      sorted_fps = fps[f, order]
+      starts = np.flatnonzero(np.diff(sorted_fps, prepend=sorted_fps[:1]) != 0)
+      starts = np.concatenate([[0], starts]) if len(order) else starts
+      bucket_sizes = np.diff(np.append(starts, len(order)))
+      if max_bucket is not None:
+        kept = bucket_sizes <= max_bucket
+        order = order[np.repeat(kept, bucket_sizes)]
+        bucket_sizes = np.where(kept, bucket_sizes, 0)
+
+      keys.append(sorted_fps[starts])
+      sizes.append(bucket_sizes)
+      ids.append(order.astype(np.int32))
+      tables.append(tables[-1] + len(starts))
+
+  sizes = np.concatenate(sizes + [np.empty(0, dtype=np.int64)])
+  return (np.array(tables, dtype=np.int64),
+          np.concatenate(keys + [np.empty(0, dtype=np.uint64)]),
+          np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+          np.concatenate(ids + [np.empty(0, dtype=np.int32)]))
+
+
+def align(position: int) -> int:
+  """Round a position in the file up to a multiple of ALIGNMENT.
+  """
+  return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def test_save_load(tmp_path):
+  """Check if an index loaded from a file returns the same words as the
+  dictionary it was built from.
+  """
+  import mccauley
+
+  words = []
+  for i in range(0, 100):
+    l = random.randint(1, 6)
+    words.append("".join(random.choice("abc") for j in range(l)))
+
+  families = get_bank_families(0.2, list("abcd"), 6, len(words), 20, seed=1, 
+                               folder=tmp_path)
+  hash = mccauley.get_hash_values(words, fingerprint=True, families=families)
+  index = CompactIndex.from_hash_values(words, hash)
+  index.save(tmp_path / "index.bin")
+  loaded = CompactIndex.load(tmp_path / "index.bin")
+
+  assert len(loaded.words) == len(words)
+  for query in random.sample(words, 10) + ["abcabc"]:
+    expected = mccauley.process_query(query, hash, fingerprint=True)
+    assert index.process_query(query) == expected
+    assert loaded.process_query(query) == expected
+
+def test_build(monkeypatch, tmp_path):
+  """Check if the index built from the fingerprints returns the same words as 
+  the dictionary of mccauley.get_hash_values, with and without a cap.
+  """
+  import mccauley
+  import sys
+
+  # Fingerprint 3 hash functions at a time
+  monkeypatch.setattr(sys.modules[__name__], "BUILD_LANES", 300)
+
+  words = []
+  for i in range(0, 100):
+    l = random.randint(1, 6)
+    words.append("".join(random.choice("abc") for j in range(l)))
+
+  families = get_bank_families(0.2, list("abcd"), 6, len(words), 20, seed=2, 
+                               folder=tmp_path)
+  queries = random.sample(words, 10) + ["abcabc", "d"]
+  for max_bucket, workers, trie in [(None, 1, False), (3, 1, False), 
+                                    (None, 2, False), (3, 1, True)]:
+    hash = mccauley.get_hash_values(words, fingerprint=True, 
+                                    families=families, max_bucket=max_bucket, 
+                                    split=False)
+    index = CompactIndex.build(words, list(hash), max_bucket, workers, trie)
+    assert index.get_bucket_stats() == mccauley.get_bucket_stats(hash)
+    assert len(index.words) == len(set(words))
+    assert index.ids.dtype == np.int32
+
+    candidates = index.get_candidates(queries)
+    results, counts = index.process_queries(queries, k=3, max_ed=2)
+    expected = mccauley.process_queries(queries, hash, k=3, max_ed=2, 
+                                        fingerprint=True)
+    assert (results, counts) == expected
+    for query, ids in zip(queries, candidates):
+      similar = mccauley.process_query(query, hash, fingerprint=True)
+      assert {index.words[j] for j in ids} == similar
+      assert index.process_query(query) == similar
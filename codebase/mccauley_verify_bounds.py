@@ -1,7 +1,11 @@
-from   hash_family import HashFamily, get_p_values
-from   Levenshtein import editops
+from   hash_bank    import get_bank_families, load_bank
+from   hash_family  import HashFamily, fingerprint_bank, get_p_values
+from   hash_family  import get_seeds
+from   verification import edit_distance as get_edit_distance
 import math
+import numpy as np
 import random
+import sys
 
 # Concatenating the strings to 100 alphabets.
 MAX_STRING_SIZE = 100 
@@ -13,6 +17,8 @@ ACCEPTABLE_CHARS = ['A', 'T', 'C', 'G', '$']
 P_VALUE = random.uniform(0, 1/3)
 # Number of hash functions.
 NUM_HASH_FUNC=1000
+# z value of the 95% confidence intervals.
+Z_VALUE = 1.96
 
 
 def get_dataset():
@@ -23,101 +29,106 @@ def get_dataset():
   return seq
 
 
-def hash_strs(words: list) -> dict:
-  """Hash all the strings in the list based on the hash function.
+def edit_distance(words):
+  """Return the edit distance of the two strings.
+  """
+  return get_edit_distance(words[0], words[1])
+
+
+def get_hash_functions(hash_func: int=NUM_HASH_FUNC, seed: int=None) -> list:
+  """Sample a bank of seeded hash functions with p = P_VALUE.
 
   Args:
-    text: list of strings
+    hash_func: number of hash functions
+    seed:      master seed, a random one is drawn if not given
 
   Returns:
-    Dict of list of file index containing the key as hashed_str and
-    an object of the HashFamily class
+    List of objects of the HashFamily class
   """
-  # Define the hash function
+  if seed is None:
+    seed = random.getrandbits(64)
   pa, pr = get_p_values(P_VALUE)
-  rho = HashFamily(pa, 
-                   pr, 
-                   str_len=MAX_STRING_SIZE, 
-                   num_strings=NUM_STRINGS,
-                   alphabet=ACCEPTABLE_CHARS)
+  return [HashFamily(pa, 
+                     pr, 
+                     str_len=MAX_STRING_SIZE, 
+                     num_strings=NUM_STRINGS,
+                     alphabet=ACCEPTABLE_CHARS,
+                     seed=s) 
+          for s in get_seeds(seed, hash_func)]
 
-  # Get the hash values
-  hash_values = {}
-  
-  for string in words:
-    hashed_str = rho.hash_str(string)
 
-    # We consider the string only if its transcript is complete.
-    if hashed_str != "NOT-COMPLETE":
-      if hashed_str in hash_values:
-        hash_values[hashed_str].append(string)
-      else:
-        hash_values[hashed_str] = [string]
+def estimate_probabilities(pairs: list, families: list) -> list:
+  """Estimate P(h(x)=h(y)) for many pairs with one bank of hash functions.
 
-  return (hash_values, rho)
-
-
-def get_hash_values(words: list, hash_func: int=NUM_HASH_FUNC) -> set:
-  """Traverse through all the words for NUM_HASH_FUNC times and generate a 
-  dictionary used to compare the queries later.
+  The fingerprints of all the strings are computed under all the hash functions
+  at once, and h(x)=h(y) is then checked for every pair and every hash function
+  with array comparisons.
 
   Args:
-    words: list of all the words
-    hash_func: number of hash functions used
+    pairs:    list of pairs of strings
+    families: bank of seeded hash functions, see get_hash_functions
 
   Returns:
-    Dictionary of hash function and the hash values.
+    List of tuples of the estimated probability and the lower and upper ends of
+    its Wilson confidence interval, for every pair.
   """
-  # Dictionary with keys as the hash function rho and value as the buckets.
-  hash={}
-  for _ in range(0, hash_func):
-    hash_values, rho = hash_strs(words)
-    hash[rho] = hash_values
-  
-  return hash
+  strings = list({x for pair in pairs for x in pair})
+  index = {x: i for i, x in enumerate(strings)}
+  x = np.array([index[pair[0]] for pair in pairs], dtype=np.int64)
+  y = np.array([index[pair[1]] for pair in pairs], dtype=np.int64)
 
+  fps, complete = fingerprint_bank(families, strings)
+  # Both strings must have a complete transcript to share a bucket.
+  similar = (fps[:, x] == fps[:, y]) & complete[:, x] & complete[:, y]
+  prob = similar.sum(axis=0) / len(families)
 
-def edit_distance(words):
-  """Return the edit distance operations of the two strings.
-  """
-  ed = editops(words[0], words[1])
-  return ed
+  # Wilson score interval
+  n = len(families)
+  z2 = Z_VALUE**2
+  center = (prob + z2 / (2 * n)) / (1 + z2 / n)
+  half = (Z_VALUE * np.sqrt(prob * (1 - prob) / n + z2 / (4 * n**2)) / 
+          (1 + z2 / n))
 
+  return list(zip(prob.tolist(), 
+                  (center - half).tolist(), 
+                  (center + half).tolist()))
 
-def get_probabilities(words: list):
-  """Get hash values for the words in the list and print the probability of them
-  being equal.
+
+def print_probabilities(pairs: list, families: list, p: float=P_VALUE):
+  """Print the estimated probability of h(x)=h(y) and its bounds for every pair.
 
   Args:
-    words: List of 2 words.
+    pairs:    list of pairs of strings
+    families: bank of seeded hash functions
+    p:        the value of p of the hash functions
   """
-  ed = edit_distance(words)
-  hash = get_hash_values(words)
-
-  # Get the count of hash functions which hashed both the strings together.  
-  similar = 0
-  for h in hash.values():
-    if len(h.keys())==1 and len(list(h.values())[0])==2:
-      similar += 1
+  estimates = estimate_probabilities(pairs, families)
+  for words, (prob, low, high) in zip(pairs, estimates):
+    ed = edit_distance(words)
+    upper = p**ed
+    lower = (p**ed)-(2/(NUM_STRINGS**2))
 
-  # Calculate Probability, upper bound and lower bound.
-  prob = similar/NUM_HASH_FUNC
-  upper = P_VALUE**(len(ed))
-  lower = (P_VALUE**(len(ed)))-(2/(NUM_STRINGS**2))
+    print(f"value of p={p}, and r={ed}")
+    print(f"Probability of h(x)=h(y) is: {prob} "
+          f"(95% confidence interval [{low}, {high}])")
+    print(f"p^r={upper}")
+    print(f"p^r-2/n^2={lower}")
+    print(f"Is probability in bounds?: {prob<=upper and prob>=lower}")
 
-  # Print all the values.  
-  print(f"value of p={P_VALUE}, and r={len(ed)}")
-  print(f"Probability of h(x)=h(y) is: {prob}")
-  print(f"p^r={upper}")
-  print(f"p^r-2/n^2={lower}")
-  print(f"Is probability in bounds?: {prob<=upper and prob>=lower}")
 
-
-def main():
+def main(bank_id: str=None):
   seq = get_dataset()
   num_runs = 100
+  if bank_id is None:
+    families = get_hash_functions()
+    p = P_VALUE
+  else:
+    bank = load_bank(bank_id)
+    families = bank.families
+    p = bank.p
 
   print("For strings with lower edit distance:")
+  pairs = []
   for _ in range(0, num_runs):
     word = random.choice(seq)
     word2 = word
@@ -125,15 +136,34 @@ def main():
     for i in range(0, diff):
       r = math.floor(random.random()*len(word2))
       word2 = word2[:i] + word2[i+1:]
-    words = [word, word2]
-    get_probabilities(words)
+    pairs.append([word, word2])
+  print_probabilities(pairs, families, p)
 
   print("For strings with higher edit distance:")
-  for _ in range(0, num_runs):
-    words = random.sample(seq, 2)
-    get_probabilities(words)
-  
+  pairs = [random.sample(seq, 2) for _ in range(0, num_runs)]
+  print_probabilities(pairs, families, p)
+
 
 
 if __name__ == "__main__":
-  main()
+  main(*sys.argv[1:])
+
+
+def test_estimate_probabilities(tmp_path):
+  """Check if the bulk estimate counts the same collisions as hashing the pairs 
+  with every hash function.
+  """
+  seq = ["".join(random.choice(ACCEPTABLE_CHARS[:4]) 
+                 for j in range(random.randint(1, 6))) for i in range(0, 10)]
+  pairs = [random.sample(seq, 2) for i in range(0, 10)] + [[seq[0], seq[0]]]
+  families = get_bank_families(0.2, ACCEPTABLE_CHARS, MAX_STRING_SIZE, 
+                               NUM_STRINGS, 50, seed=3, folder=tmp_path)
+  estimates = estimate_probabilities(pairs, families)
+  for words, (prob, low, high) in zip(pairs, estimates):
+    similar = 0
+    for rho in families:
+      hashed = rho.hash_many(words)
+      if hashed[0] == hashed[1] and hashed[0] != "NOT-COMPLETE":
+        similar += 1
+    assert prob == similar / len(families)
+    assert low <= prob <= high
@@ -0,0 +1,322 @@
+"""
+Passage-level MinHash: near-duplicate windows across documents.
+
+A copied chapter in a long book is diluted in the shingles of the whole book, so
+every document is split into overlapping windows of WINDOW_SIZE shingles, one
+every WINDOW_STRIDE shingles, and every window gets its own MinHash signature.
+The hash values of a document are computed once: the minimum over every block
+of WINDOW_STRIDE shingles is taken with np.minimum.reduceat, and the signature
+of a window is the minimum over its WINDOW_SIZE / WINDOW_STRIDE blocks. The
+windows of all the documents are banded as in jaccard_distance, and the pairs of
+windows of different documents sharing a band are verified with the exact 
+Jaccard of their shingles and reported with their character offsets. The 
+windows are signed with MixedHash functions by default: with the small 
+multipliers of UniversalHash the minimum of most windows is the hash of the 
+same few shingle ids, and windows of unrelated books share their bands. The 
+windows and signatures of every document are kept in the cache of 
+shingle_cache.
+"""
+from   docx             import Document
+from   jaccard_distance import BAND_SIZE, CHUNK_SIZE, DATA_FOLDER, SHINGLE_SIZE
+from   jaccard_distance import ACCEPTABLE_CHARS, EMPTY_SIGNATURE
+from   jaccard_distance import MixedHash, OnePermutationHash
+from   jaccard_distance import band_hashes, build_signature_matrix
+from   jaccard_distance import exact_jaccard, get_band_buckets, get_document
+from   jaccard_distance import get_files, get_hash_funcs, get_hash_params
+from   jaccard_distance import hash_values, shingle_ids
+from   shingle_cache    import get_cache_key, load_windows, store_windows
+import hashlib
+import itertools
+import json
+import numpy as np
+import random
+import sys
+
+# Number of shingles in a window
+WINDOW_SIZE = 2048
+# Number of shingles between the starts of two windows
+WINDOW_STRIDE = 1024
+# Jaccard similarity of the pairs of windows reported by match_passages
+PASSAGE_THRESHOLD = 0.5
+
+
+def get_windows(num_shingles: int,
+                size: int=WINDOW_SIZE,
+                stride: int=WINDOW_STRIDE) -> np.ndarray:
+  """Windows of shingles of a document.
+
+  The windows start every stride shingles and the last one ends at the last
+  shingle, so it may be shorter than size. A document shorter than size is a
+  single window.
+
+  Args:
+    num_shingles: number of shingles of the document
+    size: number of shingles in a window, a multiple of stride
+    stride: number of shingles between the starts of two windows
+
+  Returns:
+    Array of num_of_windows * 2 of the first shingle of every window and the
+    one after its last shingle
+  """
+  if size % stride:
+    raise ValueError("size must be a multiple of stride")
+
+  num_blocks = -(-num_shingles // stride)
+  num_windows = max(num_blocks - size // stride + 1, 1) if num_blocks else 0
+  starts = np.arange(0, num_windows, dtype=np.int64) * stride
+  return np.stack([starts, np.minimum(starts + size, num_shingles)], axis=1)
+
+
+def window_signatures(ids: np.ndarray,
+                      hash_funcs: list,
+                      size: int=WINDOW_SIZE,
+                      stride: int=WINDOW_STRIDE,
+                      chunk_size: int=CHUNK_SIZE) -> tuple:
+  """MinHash signatures of the windows of a document.
+
+  Args:
+    ids: shingle ids of the document in order, see shingle_ids
+    hash_funcs: list of objects of the MixedHash or UniversalHash class
+    size: number of shingles in a window, a multiple of stride
+    stride: number of shingles between the starts of two windows
+    chunk_size: number of shingles hashed at once, rounded to a multiple of
+                stride
+
+  Returns:
+    Tuple of the array of windows, see get_windows, and the uint32 signature
+    matrix of num_of_windows * num_of_hash_functions. The signature of every
+    window is the same as the one of build_signature_matrix.
+  """
+  check_hash_funcs(hash_funcs)
+  ids = np.asarray(ids).astype(np.uint64)
+  chunk_size = max(chunk_size // stride, 1) * stride
+  blocks = []
+  for start in range(0, len(ids), chunk_size):
+    values = hash_values(ids[start:start + chunk_size], hash_funcs)
+    offsets = np.arange(0, len(values), stride)
+    blocks.append(np.minimum.reduceat(values, offsets, axis=0))
+  blocks = np.concatenate(blocks) if blocks else np.empty((0, len(hash_funcs)))
+
+  windows = get_windows(len(ids), size, stride)
+  signature = np.full((len(windows), len(hash_funcs)), EMPTY_SIGNATURE,
+                      dtype=np.uint64)
+  for k in range(0, size // stride):
+    # Block k of every window, a single window may have fewer blocks
+    block = np.minimum(np.arange(0, len(windows)) + k, len(blocks) - 1)
+    signature = np.minimum(signature, blocks[block])
+
+  return (windows, signature.astype(np.uint32))
+
+
+def check_hash_funcs(hash_funcs):
+  """Reject the hash functions whose window signatures cannot be computed.
+
+  The bins of one permutation hashing are densified over the whole set of 
+  shingles, so the signature of a window is not the minimum of the signatures
+  of its blocks.
+  """
+  if isinstance(hash_funcs, OnePermutationHash):
+    raise ValueError("Passages need a list of UniversalHash, one permutation "
+                     "hashing is not supported")
+
+
+def get_windows_key(f: str,
+                    hash_funcs: list,
+                    size: int=WINDOW_SIZE,
+                    stride: int=WINDOW_STRIDE) -> str:
+  """Key of the cache entry of the windows of a file.
+  """
+  check_hash_funcs(hash_funcs)
+  params = get_hash_params(hash_funcs)
+  digest = hashlib.sha256(get_cache_key(f, SHINGLE_SIZE, ACCEPTABLE_CHARS)
+                          .encode())
+  digest.update(json.dumps(["windows", size, stride, params], 
+                           sort_keys=True).encode())
+  return digest.hexdigest()
+
+
+def get_passages(f: str,
+                 hash_funcs: list,
+                 size: int=WINDOW_SIZE,
+                 stride: int=WINDOW_STRIDE,
+                 use_cache: bool=False) -> tuple:
+  """Windows of a file and their signatures, see window_signatures.
+
+  The windows are returned as character offsets of the text of get_document:
+  the shingle k covers the characters k to k + SHINGLE_SIZE - 1.
+
+  Args:
+    f: path of the file
+    hash_funcs: list of objects of the MixedHash or UniversalHash class
+    size: number of shingles in a window
+    stride: number of shingles between the starts of two windows
+    use_cache: read and store the result in the cache of shingle_cache
+  """
+  if use_cache:
+    key = get_windows_key(f, hash_funcs, size, stride)
+    entry = load_windows(key)
+    if entry is not None:
+      return entry
+
+  text = get_document(f, use_cache)[0]
+  windows, signature = window_signatures(shingle_ids(text), hash_funcs, size,
+                                         stride)
+  windows[:, 1] += SHINGLE_SIZE - 1
+  if use_cache:
+    store_windows(key, windows, signature)
+
+  return (windows, signature)
+
+
+def match_passages(files: list,
+                   hash_funcs: list=None,
+                   band_size: int=BAND_SIZE,
+                   threshold: float=PASSAGE_THRESHOLD,
+                   size: int=WINDOW_SIZE,
+                   stride: int=WINDOW_STRIDE,
+                   use_cache: bool=False) -> list:
+  """Pairs of similar windows of different documents.
+
+  The pairs of windows sharing a band are candidates, and the shingles of the
+  documents of the candidates are read again (from the cache with use_cache) 
+  to compute the exact Jaccard similarity of every candidate.
+
+  Args:
+    files: paths of the files
+    hash_funcs: list of objects of the MixedHash or UniversalHash class, 
+                HASH_FUNC_COUNT new MixedHash functions if not given
+    band_size: number of rows in a band
+    threshold: smallest Jaccard similarity of a reported pair
+    size: number of shingles in a window
+    stride: number of shingles between the starts of two windows
+    use_cache: use the cache of shingle_cache
+
+  Returns:
+    List of the tuples (doc, start, end, other_doc, other_start, other_end,
+    similarity) of the indices of the files, the character offsets of the
+    windows and the Jaccard similarity of their shingles, with 
+    doc < other_doc, by decreasing similarity
+  """
+  if hash_funcs is None:
+    hash_funcs = get_hash_funcs(mixed=True)
+
+  owners, windows, signatures = [], [], []
+  for doc, f in enumerate(files):
+    doc_windows, signature = get_passages(f, hash_funcs, size, stride,
+                                          use_cache)
+    owners.append(np.full(len(doc_windows), doc))
+    windows.append(doc_windows.reshape(-1, 2))
+    signatures.append(signature.reshape(-1, len(hash_funcs)))
+  if not owners:
+    return []
+  owners = np.concatenate(owners)
+  windows = np.concatenate(windows)
+  signature = np.concatenate(signatures)
+
+  pairs = set()
+  keys = band_hashes(signature, band_size)
+  for band in range(0, keys.shape[1]):
+    for bucket in get_band_buckets(keys[:, band]):
+      pairs.update((i, j) for i, j in itertools.combinations(bucket.tolist(), 2)
+                   if owners[i] != owners[j])
+
+  # Shingle ids in order of the documents of the candidates
+  ids = {}
+  def window_shingles(k: int) -> np.ndarray:
+    doc = owners[k]
+    if doc not in ids:
+      ids[doc] = shingle_ids(get_document(files[doc], use_cache)[0])
+    start, end = windows[k]
+    return np.unique(ids[doc][start:end - SHINGLE_SIZE + 1])
+
+  matches = []
+  for i, j in sorted(pairs):
+    s = exact_jaccard(window_shingles(i), window_shingles(j))
+    if s < threshold:
+      continue
+    if owners[i] > owners[j]:
+      i, j = j, i
+    matches.append((int(owners[i]), *windows[i].tolist(),
+                    int(owners[j]), *windows[j].tolist(), s))
+
+  matches.sort(key=lambda match: (-match[6], match[:6]))
+  return matches
+
+
+def main(threshold: str=PASSAGE_THRESHOLD):
+  files = get_files()
+  for doc, start, end, other, other_start, other_end, similarity in \
+      match_passages(files, threshold=float(threshold), use_cache=True):
+    print(files[doc], start, end, files[other], other_start, other_end,
+          similarity)
+
+if __name__ == "__main__":
+  main(*sys.argv[1:])
+
+
+def test_window_signatures():
+  """Check if the signature of every window is the one of
+  build_signature_matrix.
+  """
+  ids = np.random.randint(0, pow(2, 30), size=1000, dtype=np.uint64)
+  for hash_funcs in (get_hash_funcs(10), get_hash_funcs(10, mixed=True)):
+    for num_shingles in (0, 1, 30, 32, 33, 1000):
+      windows, signature = window_signatures(ids[:num_shingles], hash_funcs,
+                                             size=32, stride=8, chunk_size=20)
+      assert windows[:, 1].max(initial=num_shingles) == num_shingles
+      assert len(windows) == min(num_shingles, 
+                                 max(1, -(-num_shingles // 8) - 3))
+      expected = build_signature_matrix([ids[start:end] 
+                                         for start, end in windows], 
+                                        hash_funcs)
+      assert (signature == expected).all()
+
+def test_one_permutation_rejected():
+  """Check if one permutation hashing is rejected with a clear error.
+  """
+  try:
+    window_signatures(np.arange(1, 100), get_hash_funcs(10, True), 32, 8)
+  except ValueError as error:
+    assert "one permutation" in str(error)
+  else:
+    assert False
+
+def test_match_passages(tmp_path):
+  """Check if a paragraph copied in a longer document is found at its offsets.
+  """
+  rand = random.Random(5)
+  def paragraph():
+    return "".join(rand.choice("abcdefghij ") for i in range(0, 800))
+  copied = paragraph()
+
+  paragraphs = [[paragraph(), copied, paragraph()], [copied], [paragraph()]]
+  files = []
+  for doc, texts in enumerate(paragraphs):
+    document = Document()
+    for text in texts:
+      document.add_paragraph(text)
+    files.append(str(tmp_path / f"{doc}.docx"))
+    document.save(files[-1])
+
+  hash_funcs = [MixedHash(seed) for seed in range(0, 20)]
+  matches = match_passages(files, hash_funcs, size=128, stride=64)
+  assert matches and all(match[0] == 0 and match[3] == 1 for match in matches)
+  texts = [get_document(f)[0] for f in files]
+  start = texts[0].index(copied)
+  for doc, begin, end, other, other_begin, other_end, s in matches:
+    # The windows overlap the copies
+    assert begin < start + len(copied) and end > start
+    assert other_begin < len(copied)
+    assert s == exact_jaccard(
+      np.unique(shingle_ids(texts[doc][begin:end])), 
+      np.unique(shingle_ids(texts[other][other_begin:other_end])))
+  # The best windows of the copies are about half a stride apart, 
+  # (128 - 33) / (128 + 33) = 0.59
+  assert 0.55 <= matches[0][6] < 1
+
+def test_unrelated_passages():
+  """Check if no passage is matched between two unrelated novels.
+  """
+  files = [str(DATA_FOLDER / "timemach.docx"), 
+           str(DATA_FOLDER / "3_-_the_titan_s_curse.docx")]
+  assert match_passages(files) == []
@@ -0,0 +1,251 @@
+"""
+Content-addressed on-disk cache of the parsed documents and their shingles.
+
+An entry is keyed by the hash of the content of the file, the shingle size and 
+the alphabet, so it is invalidated as soon as any of them changes. It holds the
+extracted lowercase text (key.txt, utf-8) and the sorted array of shingle ids 
+(key.npy). The windows of a document and their signatures (see passages) are
+stored the same way, in key.npz, under a key that also covers the hash 
+functions. The stale entries are never read again and are evicted, least 
+recently used first, when the cache grows over its size cap. Several processes
+may share a cache: every writer goes through its own temporary file, and an 
+entry evicted by another process is a cache miss.
+"""
+from   concurrent.futures import ThreadPoolExecutor
+from   pathlib            import Path
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+
+CACHE_FOLDER = Path("./cache/")
+# Maximum size of the cache in bytes
+CACHE_MAX_BYTES = 512 * pow(2, 20)
+# Version of the format of the entries, part of the key
+CACHE_VERSION = 1
+# Extensions of the files of the entries
+EXTENSIONS = (".txt", ".npy", ".npz")
+
+
+def get_cache_key(path: str, shingle_size: int, alphabet: list) -> str:
+  """Key of the cache entry of a file.
+
+  Args:
+    path: path of the file
+    shingle_size: size of the shingles
+    alphabet: list of the acceptable characters
+
+  Returns:
+    Hexadecimal sha256 of the content of the file and the parameters
+  """
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(pow(2, 20)), b""):
+      digest.update(block)
+
+  digest.update(json.dumps([CACHE_VERSION, shingle_size, alphabet]).encode())
+  return digest.hexdigest()
+
+
+def load_entry(key: str, folder: Path=CACHE_FOLDER) -> tuple:
+  """Read an entry of the cache.
+
+  Args:
+    key: key of the entry
+    folder: folder of the cache
+
+  Returns:
+    Tuple of the text and the array of shingle ids, or None if the entry is not
+    in the cache.
+  """
+  text_path = os.path.join(folder, key + ".txt")
+  ids_path = os.path.join(folder, key + ".npy")
+  try:
+    with open(text_path, "r", encoding="utf-8", newline="") as f:
+      text = f.read()
+    ids = np.load(ids_path)
+    # Mark the entry as recently used
+    os.utime(text_path)
+    os.utime(ids_path)
+  except (OSError, ValueError):
+    # Includes the entries evicted by another process while being read
+    return None
+
+  return (text, ids)
+
+
+def store_entry(key: str, 
+                text: str, 
+                ids: np.ndarray, 
+                folder: Path=CACHE_FOLDER,
+                max_bytes: int=CACHE_MAX_BYTES):
+  """Write an entry in the cache and evict the old entries over the size cap.
+
+  Args:
+    key: key of the entry
+    text: the text of the document
+    ids: array of the shingle ids of the document
+    folder: folder of the cache
+    max_bytes: maximum size of the cache in bytes
+  """
+  os.makedirs(folder, exist_ok=True)
+  replace_file(os.path.join(folder, key + ".npy"), lambda f: np.save(f, ids))
+  replace_file(os.path.join(folder, key + ".txt"), lambda f: f.write(text), 
+               "w", encoding="utf-8", newline="")
+
+  evict(folder, max_bytes)
+
+
+def replace_file(path: str, write, mode: str="wb", **kwargs):
+  """Write a file of the cache through a temporary file.
+
+  The temporary file is unique to the writer, so a partial file is never read
+  and concurrent writers of the same entry do not overwrite each other.
+
+  Args:
+    path: path of the file
+    write: function writing the content in the open temporary file
+    mode: mode of the temporary file
+    kwargs: other arguments of open
+  """
+  fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+  try:
+    with open(fd, mode, **kwargs) as f:
+      write(f)
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+
+
+def load_windows(key: str, folder: Path=CACHE_FOLDER) -> tuple:
+  """Read the windows and signatures of a document from the cache.
+
+  Args:
+    key: key of the entry
+    folder: folder of the cache
+
+  Returns:
+    Tuple of the array of windows and the signature matrix, or None if the 
+    entry is not in the cache.
+  """
+  path = os.path.join(folder, key + ".npz")
+  try:
+    with np.load(path) as entry:
+      windows, signature = entry["windows"], entry["signature"]
+    # Mark the entry as recently used
+    os.utime(path)
+  except (OSError, ValueError, KeyError):
+    # Includes the entries evicted by another process while being read
+    return None
+
+  return (windows, signature)
+
+
+def store_windows(key: str, 
+                  windows: np.ndarray, 
+                  signature: np.ndarray,
+                  folder: Path=CACHE_FOLDER,
+                  max_bytes: int=CACHE_MAX_BYTES):
+  """Write the windows and signatures of a document in the cache and evict the
+  old entries over the size cap.
+
+  Args:
+    key: key of the entry
+    windows: array of the windows of the document
+    signature: signature matrix of the windows
+    folder: folder of the cache
+    max_bytes: maximum size of the cache in bytes
+  """
+  os.makedirs(folder, exist_ok=True)
+  replace_file(os.path.join(folder, key + ".npz"), 
+               lambda f: np.savez(f, windows=windows, signature=signature))
+
+  evict(folder, max_bytes)
+
+
+def evict(folder: Path=CACHE_FOLDER, max_bytes: int=CACHE_MAX_BYTES):
+  """Delete the least recently used entries until the cache fits in max_bytes.
+
+  Args:
+    folder: folder of the cache
+    max_bytes: maximum size of the cache in bytes
+  """
+  entries = {}
+  for entry in os.scandir(folder):
+    key, extension = os.path.splitext(entry.name)
+    if extension in EXTENSIONS and entry.is_file():
+      try:
+        stat = entry.stat()
+      except FileNotFoundError:
+        # Already evicted by another process
+        continue
+      size, used = entries.get(key, (0, 0))
+      entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+
+  total = sum(size for size, used in entries.values())
+  for key in sorted(entries, key=lambda k: entries[k][1]):
+    if total <= max_bytes:
+      break
+    for extension in EXTENSIONS:
+      try:
+        os.remove(os.path.join(folder, key + extension))
+      except FileNotFoundError:
+        pass
+    total -= entries[key][0]
+
+
+def test_cache(tmp_path):
+  """Check if the entries are read back, keyed by content and parameters, and 
+  evicted over the size cap.
+  """
+  document = tmp_path / "document.docx"
+  document.write_bytes(b"content")
+  key = get_cache_key(document, 5, ["a", "b"])
+  assert key != get_cache_key(document, 4, ["a", "b"])
+  assert key != get_cache_key(document, 5, ["a", "c"])
+  assert load_entry(key, tmp_path / "cache") is None
+
+  store_entry(key, "text\r\n", np.arange(10, dtype=np.uint32), 
+              tmp_path / "cache")
+  text, ids = load_entry(key, tmp_path / "cache")
+  assert text == "text\r\n" and ids.tolist() == list(range(10))
+
+  document.write_bytes(b"new content")
+  new_key = get_cache_key(document, 5, ["a", "b"])
+  assert new_key != key
+  os.utime(tmp_path / "cache" / (key + ".npy"), (0, 0))
+  os.utime(tmp_path / "cache" / (key + ".txt"), (0, 0))
+  store_entry(new_key, "new text", np.arange(10, dtype=np.uint32), 
+              tmp_path / "cache", max_bytes=300)
+  assert load_entry(key, tmp_path / "cache") is None
+  assert load_entry(new_key, tmp_path / "cache")[0] == "new text"
+
+  windows = np.array([[0, 10], [5, 15]])
+  signature = np.arange(6, dtype=np.uint32).reshape(2, 3)
+  assert load_windows(key, tmp_path / "cache") is None
+  store_windows(key, windows, signature, tmp_path / "cache")
+  entry = load_windows(key, tmp_path / "cache")
+  assert (entry[0] == windows).all() and (entry[1] == signature).all()
+
+def test_concurrent_cache(tmp_path):
+  """Check if concurrent writers of the same entries and evictions of the 
+  entries being read never fail.
+  """
+  folder = tmp_path / "cache"
+  ids = np.arange(200, dtype=np.uint32)
+  def fill(worker):
+    for i in range(0, 100):
+      key = str(i % 8)
+      store_entry(key, key * 100, ids, folder, max_bytes=2000)
+      store_windows(key, ids.reshape(-1, 2), ids.reshape(-1, 2), folder, 
+                    max_bytes=2000)
+      entry = load_entry(key, folder)
+      assert entry is None or entry[0] == key * 100
+      entry = load_windows(key, folder)
+      assert entry is None or (entry[1] == ids.reshape(-1, 2)).all()
+
+  with ThreadPoolExecutor(max_workers=8) as pool:
+    list(pool.map(fill, range(0, 8)))
+  assert not [name for name in os.listdir(folder) if name.endswith(".tmp")]
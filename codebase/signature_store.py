@@ -0,0 +1,265 @@
+"""
+Persistent store of MinHash signatures for incremental near-duplicate queries.
+
+The hash functions are drawn once and saved with the store, so the signature of
+a new document is comparable to the ones already stored. A store is a folder 
+containing:
+  params.json     the hash functions, see get_hash_params, and the band size
+  signatures.u32  the signature matrix, one row of uint32 per document
+  bands.u64       the keys of the bands of every document, see band_hashes
+  documents.txt   the name of every document, one per line
+The signature matrix is memory-mapped and the band hash tables are rebuilt from
+bands.u64 when the store is opened. Adding or querying a document costs the 
+signature of that document plus a lookup per band. A new store uses MixedHash
+functions by default, whose signatures estimate the Jaccard similarity of real
+documents, unlike the ones of UniversalHash.
+"""
+from   docx             import Document
+from   jaccard_distance import BAND_SIZE, DATA_FOLDER, BandIndex, MixedHash
+from   jaccard_distance import OnePermutationHash
+from   jaccard_distance import band_hashes, build_signature_matrix
+from   jaccard_distance import exact_jaccard, get_document, get_hash_funcs
+from   jaccard_distance import get_hash_params, load_hash_funcs
+from   pathlib          import Path
+import json
+import numpy as np
+import os
+import random
+
+
+class SignatureStore:
+  """Folder of signatures supporting add and query of single documents.
+  """
+
+  def __init__(self, 
+               folder: Path, 
+               hash_funcs: list=None, 
+               band_size: int=BAND_SIZE,
+               use_cache: bool=False):
+    """Open the store in folder, creating it if it does not exist.
+    Args:
+        folder: folder of the store
+        hash_funcs: hash functions of a new store, HASH_FUNC_COUNT new MixedHash
+                    functions if not given, or an object of the 
+                    OnePermutationHash class. Ignored if the store exists.
+        band_size: number of rows in a band of a new store
+        use_cache: use the cache of shingle_cache for the parsed documents
+    """
+    self.folder = folder
+    self.use_cache = use_cache
+    params_path = os.path.join(folder, "params.json")
+    if os.path.isfile(params_path):
+      with open(params_path, "r") as f:
+        params = json.load(f)
+      self.hash_funcs = load_hash_funcs(params)
+      self.band_size = params["band_size"]
+    else:
+      if hash_funcs is None:
+        hash_funcs = get_hash_funcs(mixed=True)
+      self.hash_funcs = hash_funcs
+      self.band_size = band_size
+      os.makedirs(folder, exist_ok=True)
+      params = get_hash_params(hash_funcs)
+      params["band_size"] = self.band_size
+      with open(params_path, "w") as f:
+        json.dump(params, f)
+
+    self.num_bands = len(self.hash_funcs) // self.band_size
+    self.documents = []
+    documents_path = os.path.join(folder, "documents.txt")
+    if os.path.isfile(documents_path):
+      with open(documents_path, "r", encoding="utf-8") as f:
+        self.documents = f.read().splitlines()
+
+    # documents.txt is written last, drop the rows of a partial add.
+    count = len(self.documents)
+    for name, row_bytes in [("signatures.u32", 4 * len(self.hash_funcs)), 
+                            ("bands.u64", 8 * self.num_bands)]:
+      with open(os.path.join(folder, name), "ab") as f:
+        f.truncate(count * row_bytes)
+
+    self.index = BandIndex(self.num_bands)
+    for doc, keys in enumerate(self.get_band_keys()):
+      self.index.add(doc, keys)
+    self.signatures = None
+
+  def __len__(self) -> int:
+    return len(self.documents)
+
+  def get_signatures(self) -> np.ndarray:
+    """Memory-mapped signature matrix of the stored documents.
+    """
+    if self.signatures is None or len(self.signatures) != len(self):
+      self.signatures = self.map_rows("signatures.u32", np.uint32, 
+                                      len(self.hash_funcs))
+
+    return self.signatures
+
+  def get_band_keys(self) -> np.ndarray:
+    """Memory-mapped band keys of the stored documents.
+    """
+    return self.map_rows("bands.u64", np.uint64, self.num_bands)
+
+  def map_rows(self, name: str, dtype, width: int) -> np.ndarray:
+    """Memory-map the first len(self) rows of a file of the store.
+    """
+    if len(self) == 0 or width == 0:
+      return np.zeros((len(self), width), dtype=dtype)
+
+    return np.memmap(os.path.join(self.folder, name), dtype=dtype, mode="r", 
+                     shape=(len(self), width))
+
+  def get_signature(self, f: str) -> np.ndarray:
+    """Signature row of a file with the hash functions of the store.
+    """
+    text, ids = get_document(f, self.use_cache)
+    return build_signature_matrix([ids], self.hash_funcs)[0]
+
+  def add(self, f: str, name: str=None) -> int:
+    """Add a file to the store.
+
+    Args:
+      f: path of the file
+      name: name of the document, the path if not given
+
+    Returns:
+      Id of the document in the store
+    """
+    return self.add_signature(self.get_signature(f), 
+                              f if name is None else name)
+
+  def add_signature(self, signature: np.ndarray, name: str) -> int:
+    """Add a document given by its signature row.
+
+    Args:
+      signature: signature row of the document
+      name: name of the document
+
+    Returns:
+      Id of the document in the store
+    """
+    if "\n" in name:
+      raise ValueError("The name of a document cannot contain a new line")
+
+    keys = band_hashes(signature[None, :], self.band_size)[0]
+    with open(os.path.join(self.folder, "signatures.u32"), "ab") as f:
+      f.write(signature.astype(np.uint32).tobytes())
+    with open(os.path.join(self.folder, "bands.u64"), "ab") as f:
+      f.write(keys.tobytes())
+    with open(os.path.join(self.folder, "documents.txt"), "a", 
+              encoding="utf-8") as f:
+      f.write(name + "\n")
+
+    doc = len(self.documents)
+    self.documents.append(name)
+    self.index.add(doc, keys)
+    return doc
+
+  def query(self, f: str, threshold: float=0.0) -> list:
+    """Find the stored documents similar to a file.
+
+    Args:
+      f: path of the file
+      threshold: minimum estimated Jaccard similarity
+
+    Returns:
+      List of tuples (id, name, estimated similarity) of the documents sharing
+      a band with the file, sorted by decreasing similarity
+    """
+    return self.query_signature(self.get_signature(f), threshold)
+
+  def query_signature(self, 
+                      signature: np.ndarray, 
+                      threshold: float=0.0) -> list:
+    """Find the stored documents similar to a signature row.
+
+    Args:
+      signature: signature row of the document
+      threshold: minimum estimated Jaccard similarity
+
+    Returns:
+      List of tuples (id, name, estimated similarity), see query
+    """
+    keys = band_hashes(signature[None, :], self.band_size)[0]
+    candidates = np.array(sorted(self.index.query(keys)), dtype=np.int64)
+    if len(candidates) == 0:
+      return []
+
+    # The fraction of equal values estimates the Jaccard similarity
+    rows = self.get_signatures()[candidates]
+    similarity = (rows == signature).mean(axis=1)
+    order = np.argsort(-similarity, kind="stable")
+    return [(int(candidates[i]), self.documents[candidates[i]], 
+             float(similarity[i])) 
+            for i in order if similarity[i] >= threshold]
+
+
+def test_signature_store(tmp_path):
+  """Check if a document is found in the store after it is added and after the
+  store is opened again.
+  """
+  files = []
+  for i in range(0, 4):
+    document = Document()
+    document.add_paragraph("".join(random.choice("abcdefgh ") 
+                                   for k in range(0, 400)))
+    files.append(str(tmp_path / f"{i}.docx"))
+    document.save(files[-1])
+
+  store = SignatureStore(tmp_path / "store")
+  for f in files[:3]:
+    store.add(f)
+
+  result = store.query(files[1])
+  assert result[0][:2] == (1, files[1]) and result[0][2] == 1.0
+  assert store.query(files[3], threshold=0.9) == []
+
+  store = SignatureStore(tmp_path / "store")
+  assert len(store) == 3
+  assert all(isinstance(h, MixedHash) for h in store.hash_funcs)
+  assert store.query(files[1])[0] == result[0]
+  assert store.add(files[3]) == 3
+  assert store.query(files[3])[0][:2] == (3, files[3])
+
+def test_dissimilar_documents(tmp_path):
+  """Check if the estimated similarity of two unrelated novels is close to 
+  their exact Jaccard similarity.
+  """
+  files = [str(DATA_FOLDER / "timemach.docx"), 
+           str(DATA_FOLDER / "3_-_the_titan_s_curse.docx")]
+  hash_funcs = [MixedHash(seed) for seed in range(0, 100)]
+  store = SignatureStore(tmp_path / "store", hash_funcs)
+  store.add(files[0])
+  store = SignatureStore(tmp_path / "store")
+
+  signature = store.get_signature(files[1])
+  estimate = (store.get_signatures()[0] == signature).mean()
+  exact = exact_jaccard(get_document(files[0])[1], get_document(files[1])[1])
+  assert exact < 0.5 and abs(estimate - exact) < 0.15
+  assert all(similarity < 0.5 for doc, name, similarity in 
+             store.query_signature(signature))
+
+def test_one_permutation_store(tmp_path):
+  """Check if a store of one permutation hashing signatures is opened again 
+  with the same hash function.
+  """
+  files = []
+  for i in range(0, 3):
+    document = Document()
+    document.add_paragraph("".join(random.choice("abcdefgh ") 
+                                   for k in range(0, 400)))
+    files.append(str(tmp_path / f"{i}.docx"))
+    document.save(files[-1])
+
+  hash_funcs = get_hash_funcs(20, one_permutation=True)
+  store = SignatureStore(tmp_path / "store", hash_funcs)
+  for f in files[:2]:
+    store.add(f)
+
+  store = SignatureStore(tmp_path / "store")
+  assert isinstance(store.hash_funcs, OnePermutationHash)
+  assert store.hash_funcs.seed == hash_funcs.seed
+  assert (store.get_signature(files[2]) == 
+          build_signature_matrix([get_document(files[2])[1]], hash_funcs)[0]
+          ).all()
+  assert store.query(files[1])[0] == (1, files[1], 1.0)
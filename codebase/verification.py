@@ -0,0 +1,72 @@
+"""
+Verification of the candidates returned by LSH under edit distance.
+
+Only the distance between two strings is needed to verify a candidate, never 
+the edit operations, and most of the candidates are discarded because their 
+distance exceeds the threshold. The distances are computed by the C kernel of 
+Levenshtein with a score cutoff, which returns threshold + 1 for every distance
+over the threshold and uses the cutoff to bound its work.
+"""
+from   Levenshtein import distance
+
+# Pairs of strings and their edit distance
+KNOWN_DISTANCES = [("", "", 0), ("", "abc", 3), ("abc", "abc", 0), 
+                   ("ab", "ba", 2), ("flaw", "lawn", 2), 
+                   ("kitten", "sitting", 3), ("saturday", "sunday", 3), 
+                   ("intention", "execution", 5)]
+
+
+def edit_distance(x: str, y: str) -> int:
+  """Edit distance between two strings, without the edit operations.
+  """
+  return distance(x, y)
+
+
+def bounded_edit_distance(x: str, y: str, k: int) -> int:
+  """Edit distance between x and y if it is at most k, else k + 1.
+
+  Args:
+    x: first string
+    y: second string
+    k: the threshold
+
+  Returns:
+    min(ED(x, y), k + 1)
+  """
+  return distance(x, y, score_cutoff=k)
+
+
+def bounded_distances(pairs: list, k: int) -> list:
+  """Bounded edit distances of a batch of pairs of strings.
+
+  Args:
+    pairs: list of tuples (x, y)
+    k:     the threshold
+
+  Returns:
+    List of min(ED(x, y), k + 1) for every pair, in the same order.
+  """
+  return [distance(x, y, score_cutoff=k) for x, y in pairs]
+
+
+def test_edit_distance():
+  """Check the distances and bounded distances of pairs of known distance.
+  """
+  for x, y, expected in KNOWN_DISTANCES:
+    assert edit_distance(x, y) == edit_distance(y, x) == expected
+    assert bounded_edit_distance(x, y, expected) == expected
+    assert bounded_edit_distance(x, y, 100) == expected
+    if expected > 0:
+      # Over the cutoff the distance is reported as k + 1
+      assert bounded_edit_distance(x, y, expected - 1) == expected
+  assert bounded_edit_distance("intention", "execution", 2) == 3
+  assert bounded_edit_distance("kitten", "sitting", 0) == 1
+
+def test_bounded_distances():
+  """Check the batch of bounded distances of pairs of known distance.
+  """
+  pairs = [(x, y) for x, y, expected in KNOWN_DISTANCES]
+  assert bounded_distances(pairs, 100) == [d for x, y, d in KNOWN_DISTANCES]
+  assert (bounded_distances(pairs, 2) == 
+          [min(d, 3) for x, y, d in KNOWN_DISTANCES])
+  assert bounded_distances([], 2) == []